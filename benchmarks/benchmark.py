@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+:url: https://github.com/allenta/zabbix-template-for-varnish-cache
+:copyright: (c) Allenta Consulting S.L. <info@allenta.com>.
+:license: BSD, see LICENSE.txt for more details.
+
+Benchmarks 'zabbix-varnish-cache.py' against synthetic 'varnishstat' and
+'varnishadm' stand-ins installed on PATH, reporting wall time, CPU time and
+peak memory per stage (measured in-process) and per command (measured as a
+child process), memory retained per collected item, plus cold start time (from exec to the first byte of output,
+as seen by the Zabbix agent). Usage example:
+
+    $ python3 benchmarks/benchmark.py --backends 2000 --accg-keys 500
+'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import importlib.util
+import io
+import json
+import os
+import py_compile
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+SCRIPT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'zabbix-varnish-cache.py')
+
+MAIN_COUNTERS = 300
+
+VBE_FIELDS = (
+    ('happy', 'b'), ('bereq_hdrbytes', 'c'), ('bereq_bodybytes', 'c'),
+    ('beresp_hdrbytes', 'c'), ('beresp_bodybytes', 'c'), ('pipe_hdrbytes', 'c'),
+    ('pipe_out', 'c'), ('pipe_in', 'c'), ('conn', 'g'), ('req', 'c'),
+    ('unhealthy', 'c'), ('busy', 'c'), ('fail', 'c'), ('fail_eacces', 'c'),
+    ('fail_eaddrnotavail', 'c'), ('fail_econnrefused', 'c'),
+    ('fail_enetunreach', 'c'), ('fail_etimedout', 'c'), ('fail_other', 'c'),
+    ('helddown', 'c'), ('is_healthy', 'g'), ('last_probe', 'g'),
+)
+
+MSE4_BOOK_FIELDS = (
+    ('online', 'g'), ('g_slots_used', 'g'), ('g_slots_unused', 'g'),
+    ('g_objects', 'g'), ('g_unreachable_objects', 'g'), ('g_varyspec', 'g'),
+    ('g_ykey_keys', 'g'), ('c_ykey_purged', 'c'), ('c_freeslot_queued', 'c'),
+    ('g_freeslot_queue', 'g'), ('c_submitslot_queued', 'c'),
+    ('g_submitslot_queue', 'g'), ('g_waterlevel', 'g'),
+)
+
+MSE4_STORE_FIELDS = (
+    ('online', 'g'), ('g_bytes_used', 'g'), ('g_bytes_unused', 'g'),
+    ('g_reserve_bytes', 'g'), ('g_objects', 'g'), ('g_allocation_queue', 'g'),
+    ('c_allocation_queued', 'c'), ('g_io_queued', 'g'),
+    ('c_io_finished_read', 'c'), ('c_io_finished_write', 'c'),
+    ('c_io_finished_bytes_read', 'c'), ('c_io_finished_bytes_write', 'c'),
+    ('g_io_blocked_read', 'g'), ('g_io_blocked_write', 'g'),
+    ('c_io_limited', 'c'), ('c_aio_finished', 'c'),
+)
+
+MSE4_CAT_FIELDS = (
+    ('g_bytes', 'g'), ('g_objects', 'g'), ('g_allocations', 'g'),
+    ('c_allocation', 'c'), ('c_free', 'c'), ('c_eviction', 'c'),
+    ('c_memcache_hit', 'c'), ('c_memcache_miss', 'c'), ('g_bytes_pass', 'g'),
+)
+
+ACCG_FIELDS = (
+    'client_req_count', 'client_req_hdrbytes', 'client_req_bodybytes',
+    'client_resp_hdrbytes', 'client_resp_bodybytes', 'client_hit_count',
+    'client_miss_count', 'client_pass_count', 'client_synth_count',
+    'client_pipe_count', 'client_200_count', 'client_304_count',
+    'client_404_count', 'client_503_count', 'client_2xx_count',
+    'client_3xx_count', 'client_4xx_count', 'client_5xx_count',
+    'backend_req_count', 'backend_req_hdrbytes', 'backend_resp_bodybytes',
+    'backend_200_count', 'backend_5xx_count',
+)
+
+
+# Fake 'varnishstat', honoring '-f' inclusion & ('^' prefixed) exclusion
+# globs.
+VARNISHSTAT = '''#!{executable}
+import fnmatch, json, re, sys
+globs = [sys.argv[i + 1] for i, arg in enumerate(sys.argv) if arg == '-f']
+def pattern(globs):
+    return re.compile('|'.join([fnmatch.translate(glob) for glob in globs] or ['(?!)']))
+included = pattern([glob for glob in globs if not glob.startswith('^')])
+excluded = pattern([glob[1:] for glob in globs if glob.startswith('^')])
+with open('{path}') as fd:
+    data = json.load(fd)
+json.dump(dict(
+    (name, value) for name, value in data.items()
+    if not isinstance(value, dict) or (
+        excluded.match(name) is None and
+        (included.pattern == '(?!)' or included.match(name) is not None))),
+    sys.stdout, indent=2)
+'''
+
+
+###############################################################################
+## SYNTHETIC DATA
+###############################################################################
+
+def counters(options):
+    # Return a 'varnishstat -1 -j' like dict.
+    result = {
+        'timestamp': '2026-01-01T00:00:00',
+    }
+
+    def add(name, flag, value):
+        result[name] = {
+            'description': 'Synthetic counter',
+            'flag': flag,
+            'format': 'i',
+            'value': value,
+        }
+
+    # MAIN & MGT: all literal items plus a bunch of uninteresting ones.
+    add('MGT.uptime', 'c', 100000)
+    add('MAIN.uptime', 'c', 99000)
+    add('MAIN.n_backend', 'g', options.backends)
+    add('MAIN.n_vcl', 'g', 1)
+    for i in range(MAIN_COUNTERS):
+        add('MAIN.counter_{}'.format(i), 'c', i * 1000)
+    for name in ('client_req', 'cache_hit', 'cache_miss', 's_sess', 'threads'):
+        add('MAIN.' + name, 'c', 123456)
+
+    # Backends, including dynamic ones & backends from a cold VCL.
+    for i in range(options.backends):
+        for vcl in ('boot', 'cold') if i % 10 == 0 else ('boot',):
+            if i % 4 == 0:
+                name = 'VBE.{}.goto.{:08x}.(10.0.{}.{}).(http://origin{}.example.com:80).(ttl:10.000000)'.format(
+                    vcl, i, i // 256 % 256, i % 256, i % 16)
+            else:
+                name = 'VBE.{}.backend_{}'.format(vcl, i)
+            for field, flag in VBE_FIELDS:
+                add('{}.{}'.format(name, field), flag, i)
+
+    # MSE4.
+    for i in range(options.mse4_books):
+        for field, flag in MSE4_BOOK_FIELDS:
+            add('MSE4_BOOK.book{}.{}'.format(i, field), flag, i)
+    for i in range(options.mse4_stores):
+        for field, flag in MSE4_STORE_FIELDS:
+            add('MSE4_STORE.book{}.store{}.{}'.format(i % max(options.mse4_books, 1), i, field), flag, i)
+    for i in range(options.mse4_categories):
+        for field, flag in MSE4_CAT_FIELDS:
+            add('MSE4_CAT.(cat{}.sub{}).{}'.format(i, i % 3, field), flag, i)
+
+    # Accounting (most of them excluded by default) & KVStore counters.
+    for i in range(options.accg_namespaces):
+        namespace = 'std' if i == 0 else 'ns{}'.format(i)
+        for j in range(options.accg_keys):
+            for field in ACCG_FIELDS:
+                add('ACCG.{}.key{}.{}'.format(namespace, j, field), 'c', j)
+    for i in range(options.kvstore_counters):
+        add('KVSTORE.counters.boot.counter{}'.format(i), 'c', i)
+
+    return result
+
+
+def backend_list(data):
+    # Return a 'varnishadm backend.list' like output for all backends of the
+    # active VCL.
+    lines = ['Backend name                   Admin      Probe                Last updated']
+    seen = set()
+    for name in data:
+        if name.startswith('VBE.boot.'):
+            backend = name[4:].rsplit('.', 1)[0]
+            if backend not in seen:
+                seen.add(backend)
+                lines.append('{} probe Healthy 5/5 Wed, 01 Jan 2026 00:00:00 GMT'.format(backend))
+    return '\n'.join(lines) + '\n'
+
+
+def vsm(data, path):
+    # Write 'Stat' & 'StatDoc' segments with all counters in a VSM directory.
+    flags = {'c': 'counter', 'g': 'gauge', 'b': 'bitmap'}
+    groups = {}
+    for name, value in data.items():
+        if isinstance(value, dict):
+            ident, field = name.rsplit('.', 1)
+            groups.setdefault(ident, []).append((field, value))
+    for directory in ('_.vsm_mgt', '_.vsm_child'):
+        os.makedirs(os.path.join(path, directory))
+        blob, index = bytearray(), ['# {} 0'.format(os.getpid())]
+        for id, (ident, fields) in enumerate(groups.items(), 1):
+            if (ident == 'MGT') != (directory == '_.vsm_mgt'):
+                continue
+            doc = json.dumps({
+                'version': '1',
+                'name': ident.split('.', 1)[0],
+                'elem': dict(
+                    (field, {'name': field, 'type': flags[value['flag']], 'index': 8 * i})
+                    for i, (field, value) in enumerate(fields)),
+            }).encode('utf-8') + b'\0'
+            for klass, body in (
+                    ('StatDoc', doc),
+                    ('Stat', b''.join(struct.pack('=Q', value['value']) for _, value in fields))):
+                segment = struct.pack('=QQQ', 1, 24, id) + body
+                index.append('+ _.Stat {} {} {} {}'.format(len(blob), len(segment), klass, ident))
+                blob += segment
+        with open(os.path.join(path, directory, '_.Stat'), 'wb') as fd:
+            fd.write(blob)
+        with open(os.path.join(path, directory, '_.index'), 'w') as fd:
+            fd.write('\n'.join(index) + '\n')
+
+
+def install(data, path):
+    # Write outputs & fake 'varnishstat' / 'varnishadm' executables.
+    with open(os.path.join(path, 'varnishstat.json'), 'w') as fd:
+        json.dump(data, fd, indent=2)
+    with open(os.path.join(path, 'backend.list'), 'w') as fd:
+        fd.write(backend_list(data))
+    with open(os.path.join(path, 'varnishstat'), 'w') as fd:
+        fd.write(VARNISHSTAT.format(
+            executable=sys.executable,
+            path=os.path.join(path, 'varnishstat.json')))
+    with open(os.path.join(path, 'varnishadm'), 'w') as fd:
+        fd.write(
+            '#!/bin/sh\n'
+            'case "$*" in\n'
+            '  *backend.list*) exec cat "{}";;\n'
+            '  *"pid -j"*) echo \'[ 2, ["pid", "-j"], 1767225600.0, {{"master": {}, "worker": {}}} ]\';;\n'
+            '  *vcl.list*) echo \'active      auto/warm          0 boot\';'
+            ' echo \'available   auto/cold          0 cold\';;\n'
+            '  *) echo "Unknown request"; exit 1;;\n'
+            'esac\n'.format(os.path.join(path, 'backend.list'), os.getpid(), os.getpid()))
+    for name in ('varnishstat', 'varnishadm'):
+        os.chmod(os.path.join(path, name), 0o755)
+
+
+CGROUP = 'system.slice/varnish.service'
+
+CGROUP_FILES = {
+    'cpu.pressure':
+        'some avg10=1.50 avg60=0.75 avg300=0.25 total=1234567\n'
+        'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n',
+    'memory.pressure':
+        'some avg10=0.10 avg60=0.20 avg300=0.30 total=2000000\n'
+        'full avg10=0.05 avg60=0.10 avg300=0.15 total=1000000\n',
+    'io.pressure':
+        'some avg10=4.00 avg60=3.00 avg300=2.00 total=5500000\n'
+        'full avg10=3.00 avg60=2.00 avg300=1.00 total=4400000\n',
+    'memory.current': '1073741824\n',
+    'memory.stat':
+        'anon 536870912\n'
+        'file 268435456\n'
+        'kernel 16777216\n'
+        'shmem 1048576\n'
+        'slab 8388608\n'
+        'sock 4096\n'
+        'file_dirty 8192\n'
+        'file_writeback 0\n'
+        'pgfault 123456\n'
+        'pgmajfault 12\n'
+        'pgscan 1000\n'
+        'pgsteal 900\n'
+        'workingset_refault_anon 5\n'
+        'workingset_refault_file 50\n',
+    'io.stat':
+        '8:0 rbytes=1048576 wbytes=2097152 rios=256 wios=512 dbytes=0 dios=0'
+        ' cost.vrate=100.00 cost.usage=1234 depth=max avg_lat=0 win=0\n'
+        '259:1 rbytes=4096 wbytes=0 rios=1 wios=0 dbytes=0 dios=0\n',
+}
+
+
+def cgroup(path, pid, version=2, missing=()):
+    # Write a fake '<path>/proc' & '<path>/sys' tree with the cgroup of 'pid'
+    # (see CGROUP_FILES): cgroup v2 ('0::' entry & a single hierarchy), or
+    # cgroup v1 (one entry & hierarchy per controller). Files listed in
+    # 'missing' are not written (e.g. 'cgroup' itself, or disabled controllers
+    # / PSI).
+    controllers = ('',) if version == 2 else ('memory', 'cpu,cpuacct', 'blkio')
+    os.makedirs(os.path.join(path, 'proc', str(pid)))
+    if 'cgroup' not in missing:
+        with open(os.path.join(path, 'proc', str(pid), 'cgroup'), 'w') as fd:
+            for id, controller in enumerate(controllers, 1 if version == 1 else 0):
+                fd.write('{}:{}:/{}\n'.format(id, controller, CGROUP))
+    for controller in controllers:
+        directory = os.path.join(path, 'sys', 'fs', 'cgroup', controller, CGROUP)
+        os.makedirs(directory)
+        for name, contents in CGROUP_FILES.items():
+            if name not in missing:
+                with open(os.path.join(directory, name), 'w') as fd:
+                    fd.write(contents)
+    os.makedirs(os.path.join(path, 'sys', 'devices', 'virtual', 'block', 'sda'))
+    os.makedirs(os.path.join(path, 'sys', 'dev', 'block'))
+    os.symlink(
+        os.path.join('..', '..', 'devices', 'virtual', 'block', 'sda'),
+        os.path.join(path, 'sys', 'dev', 'block', '8:0'))
+
+
+###############################################################################
+## MEASUREMENTS
+###############################################################################
+
+def measure_retained(function):
+    # Run a function in-process returning some stats: number of items and
+    # memory still allocated (i.e. retained by those stats) once it finishes.
+    # The function is run once before, so caches built on first use and kept
+    # by the module (classifier memo, compiled patterns, etc.) are not
+    # accounted to the stats.
+    function()
+    tracemalloc.start()
+    stats = function()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    items = sum(1 for _ in stats.items)
+    return items, retained, retained / max(items, 1)
+
+
+def measure_stage(function, repeat):
+    # Run a function in-process: best wall & CPU time, and peak of memory
+    # allocated while running it.
+    walls, cpus, peak = [], [], 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        wall, cpu = time.perf_counter(), time.process_time()
+        function()
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return min(walls), min(cpus), peak
+
+
+# Small launcher measuring a command from a fresh interpreter: on Linux peak RSS
+# of a child process starts at the RSS of its parent at fork time, which would
+# hide the real figure behind the memory used by the benchmark itself.
+LAUNCHER = '''
+import json, os, subprocess, sys, time
+wall = time.perf_counter()
+child = subprocess.Popen(sys.argv[1:], stdout=subprocess.DEVNULL)
+_, status, usage = os.wait4(child.pid, 0)
+json.dump({
+    'status': os.waitstatus_to_exitcode(status),
+    'wall': time.perf_counter() - wall,
+    'cpu': usage.ru_utime + usage.ru_stime,
+    'rss': usage.ru_maxrss * 1024,
+}, sys.stdout)
+'''
+
+
+def measure_command(argv, env, repeat):
+    # Run a command as a child process: best wall & CPU time (including its own
+    # children), and peak RSS.
+    walls, cpus, peak = [], [], 0
+    for _ in range(repeat):
+        result = json.loads(subprocess.check_output(
+            [sys.executable, '-c', LAUNCHER] + argv, env=env))
+        if result['status'] != 0:
+            raise RuntimeError('Command failed: {}'.format(' '.join(argv)))
+        walls.append(result['wall'])
+        cpus.append(result['cpu'])
+        peak = max(peak, result['rss'])
+    return min(walls), min(cpus), peak
+
+
+def measure_cold_start(argv, env, repeat):
+    # Run a command as a child process: best time from exec to the first byte
+    # of output, and to its completion.
+    firsts, totals = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        child = subprocess.Popen(argv, env=env, stdout=subprocess.PIPE)
+        child.stdout.read(1)
+        firsts.append(time.perf_counter() - start)
+        child.communicate()
+        totals.append(time.perf_counter() - start)
+        if child.returncode != 0:
+            raise RuntimeError('Command failed: {}'.format(' '.join(argv)))
+    return min(firsts), min(totals)
+
+
+def daemon(argv, env, path):
+    # Start a collector daemon and wait for it to answer requests.
+    child = subprocess.Popen(argv, env=env, stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        if os.path.exists(path):
+            return child
+        time.sleep(0.1)
+    child.terminate()
+    raise RuntimeError('Collector daemon not available')
+
+
+def report(title, columns, rows, stream):
+    stream.write('\n{}\n'.format(title))
+    stream.write('{:<40}'.format('') + ''.join(
+        ' {:>14}'.format(label) for label, _ in columns) + '\n')
+    for name, values in rows:
+        stream.write('{:<40}'.format(name) + ''.join(
+            ' {:>14.1f}'.format(value / scale)
+            for (_, scale), value in zip(columns, values)) + '\n')
+
+
+###############################################################################
+## MAIN
+###############################################################################
+
+def main():
+    # Parse command line arguments.
+    parser = ArgumentParser(description='Benchmark zabbix-varnish-cache.py.')
+    parser.add_argument('--backends', type=int, default=500)
+    parser.add_argument('--mse4-books', dest='mse4_books', type=int, default=4)
+    parser.add_argument('--mse4-stores', dest='mse4_stores', type=int, default=16)
+    parser.add_argument('--mse4-categories', dest='mse4_categories', type=int, default=50)
+    parser.add_argument('--accg-namespaces', dest='accg_namespaces', type=int, default=5)
+    parser.add_argument('--accg-keys', dest='accg_keys', type=int, default=200)
+    parser.add_argument('--kvstore-counters', dest='kvstore_counters', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--json', dest='json', action='store_true', default=False,
+        help='render results as JSON')
+    options = parser.parse_args()
+
+    # Generate synthetic data & install fake executables.
+    workdir = tempfile.mkdtemp(prefix='zabbix-varnish-cache-benchmark-')
+    try:
+        data = counters(options)
+        install(data, workdir)
+        vsm(data, os.path.join(workdir, 'vsm'))
+        cgroup(os.path.join(workdir, 'cgroup'), os.getpid())
+        env = dict(os.environ, PATH=workdir + os.pathsep + os.environ.get('PATH', ''))
+        os.environ['PATH'] = env['PATH']
+
+        # Load the script as a module.
+        spec = importlib.util.spec_from_file_location('zabbix_varnish_cache', SCRIPT)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        parse = lambda *argv: module._parser().parse_args(
+            ['-i', 'benchmark', '-d', os.path.join(workdir, 'state')] + list(argv))
+        names = [name for name, value in data.items() if isinstance(value, dict)]
+
+        def cgroup_stats(exclusions=parse('stats').exclusions):
+            proc_dir, sys_dir = module.PROC_DIR, module.SYS_DIR
+            module.PROC_DIR = os.path.join(workdir, 'cgroup', 'proc')
+            module.SYS_DIR = os.path.join(workdir, 'cgroup', 'sys')
+            try:
+                module._cgroup_stats(
+                    module.Stats(module.ITEMS, module.SUBJECTS, exclusions), os.getpid())
+            finally:
+                module.PROC_DIR, module.SYS_DIR = proc_dir, sys_dir
+
+        def build_items(warm):
+            if not warm:
+                module._CLASSIFIERS.clear()
+            stats = module.Stats(module.ITEMS, module.SUBJECTS, parse('stats').exclusions)
+            for name in names:
+                stats.build_item(name, 0, module.TYPE_COUNTER)
+
+        stages = [
+            ('Stats.build_item() (cold)', lambda: build_items(False)),
+            ('Stats.build_item() (warm)', lambda: build_items(True)),
+            ('_stats()', lambda: module._stats('benchmark', parse('stats'))),
+            ('_stats() --source vsm', lambda: module._stats(
+                os.path.join(workdir, 'vsm'), parse('--source', 'vsm', 'stats'))),
+            ('_cgroup_stats() (fake cgroup v2)', cgroup_stats),
+            ('stats()', lambda: module.stats(parse('stats'), io.StringIO())),
+            ('discover() backends', lambda: module.discover(parse('discover', 'backends'), io.StringIO())),
+        ]
+        footprints = [
+            ('_stats()', lambda: module._stats('benchmark', parse('stats'))),
+            ('_stats() (no exclusions)', lambda: module._stats(
+                'benchmark', parse('-e', '^(?!)', 'stats'))),
+        ]
+        commands = [
+            ('stats', ['stats']),
+            ('stats --source vsm', ['-i', os.path.join(workdir, 'vsm'), '--source', 'vsm', 'stats']),
+            ('discover items', ['discover', 'items']),
+            ('discover backends', ['discover', 'backends']),
+        ]
+        socket = os.path.join(workdir, 'collector.sock')
+        bytecode = os.path.join(workdir, 'zabbix-varnish-cache.pyc')
+        py_compile.compile(SCRIPT, cfile=bytecode, doraise=True)
+        cold_starts = [
+            ('discover items', SCRIPT, ['discover', 'items']),
+            ('discover items (precompiled)', bytecode, ['discover', 'items']),
+            ('stats', SCRIPT, ['stats']),
+            ('stats --socket (collector daemon)', SCRIPT, ['-s', socket, 'stats']),
+            ('stats --socket (precompiled)', bytecode, ['-s', socket, 'stats']),
+        ]
+
+        # Run benchmarks.
+        results = {
+            'counters': len(names),
+            'stages': [
+                (name, measure_stage(function, options.repeat))
+                for name, function in stages],
+            'footprints': [
+                (name, measure_retained(function))
+                for name, function in footprints],
+            'commands': [
+                (name, measure_command(
+                    [sys.executable, SCRIPT, '-i', 'benchmark',
+                     '-d', os.path.join(workdir, 'state')] + argv,
+                    env, options.repeat))
+                for name, argv in commands],
+        }
+        collector = daemon(
+            [sys.executable, SCRIPT, '-i', 'benchmark', '-d', os.path.join(workdir, 'state'),
+             '-s', socket, 'serve'],
+            env, socket)
+        try:
+            results['cold_starts'] = [
+                (name, measure_cold_start(
+                    [sys.executable, script, '-i', 'benchmark',
+                     '-d', os.path.join(workdir, 'state')] + argv,
+                    env, options.repeat))
+                for name, script, argv in cold_starts]
+        finally:
+            collector.terminate()
+            collector.wait()
+    finally:
+        shutil.rmtree(workdir)
+
+    # Render output.
+    if options.json:
+        sys.stdout.write(json.dumps(results, indent=2) + '\n')
+    else:
+        sys.stdout.write('{} counters\n'.format(results['counters']))
+        report(
+            'Stages (in-process, memory is peak allocated)',
+            [('wall (ms)', 1e-3), ('cpu (ms)', 1e-3), ('memory (KiB)', 1024)],
+            results['stages'], sys.stdout)
+        report(
+            'Memory footprint (in-process, memory retained by collected stats)',
+            [('items', 1), ('memory (KiB)', 1024), ('bytes / item', 1)],
+            results['footprints'], sys.stdout)
+        report(
+            'Commands (child process, memory is peak RSS)',
+            [('wall (ms)', 1e-3), ('cpu (ms)', 1e-3), ('memory (KiB)', 1024)],
+            results['commands'], sys.stdout)
+        report(
+            'Cold start (child process, from exec)',
+            [('first byte (ms)', 1e-3), ('total (ms)', 1e-3)],
+            results['cold_starts'], sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
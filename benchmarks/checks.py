@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+:url: https://github.com/allenta/zabbix-template-for-varnish-cache
+:copyright: (c) Allenta Consulting S.L. <info@allenta.com>.
+:license: BSD, see LICENSE.txt for more details.
+
+Functional checks of 'zabbix-varnish-cache.py' readers & clients that can't be
+exercised by 'benchmarks/benchmark.py'. Usage example:
+
+    $ sudo python3 benchmarks/checks.py vsm-capture -n '' /tmp/vsm-capture
+    $ python3 benchmarks/checks.py vsm [/tmp/vsm-capture]
+    $ python3 benchmarks/checks.py cli
+    $ python3 benchmarks/checks.py cgroup
+    $ python3 benchmarks/checks.py send
+'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import re
+import shutil
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+from argparse import ArgumentParser
+
+import benchmark
+
+SCRIPT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'zabbix-varnish-cache.py')
+
+# Directory of VSM captures (one per release) checked by default.
+VSM_CAPTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vsm')
+
+
+def load():
+    # Load the script as a module.
+    spec = importlib.util.spec_from_file_location('zabbix_varnish_cache', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+###############################################################################
+## VSM
+###############################################################################
+
+def vsm_capture(module, instance, path):
+    # Capture the VSM of a live instance: 'Stat' & 'StatDoc' segments, plus
+    # counters returned by _varnishstat_counters() right before & after copying
+    # them (counters keep changing while being copied).
+    stats = module.Stats(module.ITEMS, module.SUBJECTS, re.compile(r'^(?!)'))
+    filters = module._varnishstat_filters(re.compile(r'^(?!)'))
+
+    def counters():
+        result = module._varnishstat_counters(stats, instance, filters)
+        if result is None:
+            raise RuntimeError('Failed to execute varnishstat')
+        return [list(counter) for counter in result]
+
+    before = counters()
+    for directory in ('_.vsm_mgt', '_.vsm_child'):
+        source = os.path.join(module._workdir(instance), directory)
+        target = os.path.join(path, directory)
+        os.makedirs(target)
+        files = set(
+            filename
+            for filename, offset, length, klass, ident in module._vsm_segments(source)
+            if klass in ('Stat', 'StatDoc'))
+        for filename in ['_.index'] + sorted(files):
+            shutil.copyfile(os.path.join(source, filename), os.path.join(target, filename))
+    after = counters()
+
+    with open(os.path.join(path, 'varnishstat.json'), 'w') as fd:
+        json.dump({'before': before, 'after': after}, fd)
+    return len(after)
+
+
+def vsm_check(module, path):
+    # Compare counters read by _vsm_counters() from a captured VSM with the
+    # ones returned by _varnishstat_counters() while capturing it: same names
+    # (ignoring counters created or removed during the capture), same flags,
+    # and values within the ones seen before & after the copy. Returns a list
+    # of failures.
+    stats = module.Stats(module.ITEMS, module.SUBJECTS, re.compile(r'^(?!)'))
+    counters = module._vsm_counters(stats, path)
+    if counters is None:
+        return ['Failed to read counters from the VSM']
+    with open(os.path.join(path, 'varnishstat.json'), 'r') as fd:
+        reference = json.load(fd)
+
+    def index(counters):
+        return dict(
+            (name, (flag, value))
+            for name, flag, value in counters
+            if stats.accepts(name) or name.endswith('.is_healthy'))
+
+    before, after = index(reference['before']), index(reference['after'])
+    vsm = index(counters)
+    failures = []
+    for name in sorted(set(before) & set(after) - set(vsm)):
+        failures.append('{}: missing in the VSM'.format(name))
+    for name in sorted(set(vsm) - set(before) - set(after)):
+        failures.append('{}: unknown to varnishstat'.format(name))
+    for name, (flag, value) in sorted(vsm.items()):
+        if name not in before or name not in after:
+            continue
+        if flag != before[name][0]:
+            failures.append('{}: flag {!r} != {!r}'.format(name, flag, before[name][0]))
+        # Bitmaps can't be ordered: they must match one of both captures.
+        low, high = sorted((before[name][1], after[name][1]))
+        if (value not in (low, high)) if flag == 'b' else not low <= value <= high:
+            failures.append('{}: value {} not in [{}, {}]'.format(name, value, low, high))
+    return failures
+
+
+###############################################################################
+## CLI
+###############################################################################
+
+class FakeCLIHandler(socketserver.StreamRequestHandler):
+    '''
+    Emulates the varnishd management CLI: '%-3d %-8zd\\n' status lines, a 107
+    challenge when a secret is configured (a new one after a failed 'auth'),
+    and a few commands. 'echo' returns its unquoted arguments as a JSON list,
+    'big' a body larger than any single read and 'truncate' a partial
+    response (then closes the connection).
+    '''
+
+    def handle(self):
+        secret = self.server.secret
+        if secret is None:
+            self.respond(200, 'Varnish Cache CLI 1.0')
+        else:
+            challenge = self.challenge()
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            args = self.split(line.decode('utf-8').rstrip('\n'))
+            self.server.commands.append(args)
+            if secret is not None:
+                if args[:1] == ['auth'] and len(args) == 2 and args[1] == hashlib.sha256(
+                        challenge + b'\n' + secret + challenge + b'\n').hexdigest():
+                    secret = None
+                    self.respond(200, 'Varnish Cache CLI 1.0')
+                elif args[:1] == ['auth']:
+                    challenge = self.challenge()
+                else:
+                    self.respond(107, 'Authentication required.')
+            elif args == ['pid', '-j']:
+                self.respond(200, '[ 2, ["pid", "-j"], 1767225600.0, {"master": 1, "worker": 2} ]')
+            elif args[:1] == ['echo']:
+                self.respond(200, json.dumps(args[1:]))
+            elif args == ['big']:
+                self.respond(200, 'x' * 100000)
+            elif args == ['truncate']:
+                self.wfile.write(b'200 100     \nxxx')
+                break
+            else:
+                self.respond(101, 'Unknown request.\nType \'help\' for more info.')
+
+    def challenge(self):
+        challenge = os.urandom(16).hex().encode('ascii')
+        self.respond(107, challenge.decode('ascii') + '\n\nAuthentication required.\n')
+        return challenge
+
+    def respond(self, status, body):
+        body = body.encode('utf-8')
+        header = '{:<3d} {:<8d}\n'.format(status, len(body)).encode('ascii')
+        assert len(header) == 13
+        self.wfile.write(header + body + b'\n')
+        self.wfile.flush()
+
+    @staticmethod
+    def split(line):
+        # Split a command line as varnishd does: whitespace separated words
+        # or double quoted strings, both with '\\', '\"' & '\n' escapes.
+        return [
+            re.sub(
+                r'\\(.)',
+                lambda m: '\n' if m.group(1) == 'n' else m.group(1),
+                match.group(1) if match.group(1) is not None else match.group(2))
+            for match in re.finditer(
+                r'"((?:[^"\\]|\\.)*)"|((?:[^\s\\]|\\.)+)', line)]
+
+
+class FakeCLIServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, secret):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), FakeCLIHandler)
+        self.secret = secret
+        self.commands = []
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def address(self):
+        return self.server_address[0], str(self.server_address[1])
+
+
+def cli_check(module):
+    # Exercise VarnishCLI (and _varnishadm() on top of it) against a fake
+    # varnishd CLI. Returns a list of failures.
+    failures = []
+
+    def check(name, condition, details=''):
+        if not condition:
+            failures.append('{}{}'.format(name, ': ' + details if details else ''))
+
+    def raises(function, *args):
+        try:
+            function(*args)
+        except (IOError, OSError) as e:
+            return str(e)
+        return None
+
+    secret = b'e8d7c6b5-a4f3-4e2d-9c1b-0a9f8e7d6c5b\n'
+    server = FakeCLIServer(secret)
+    unauthenticated = FakeCLIServer(None)
+    try:
+        # Authentication: 107 challenge solved using the secret, several
+        # commands over a single connection, quoting of arguments.
+        cli = module.VarnishCLI([server.address], secret)
+        status, body = cli.execute('pid', '-j')
+        check('auth', status == 200 and json.loads(body)[3]['worker'] == 2,
+              '{} {!r}'.format(status, body))
+        check('auth', [args[0] for args in server.commands] == ['auth', 'pid'],
+              repr(server.commands))
+        words = ['plain', 'with space', 'with "quotes"', 'back\\slash', 'new\nline', '']
+        status, body = cli.execute('echo', *words)
+        check('quoting', status == 200 and json.loads(body) == words, body)
+        check('reuse', len([args for args in server.commands if args[0] == 'auth']) == 1)
+
+        # Status lines: non-200 responses are returned (& mapped to a non-zero
+        # status by _varnishadm(), without falling back to varnishadm), and
+        # bodies larger than a single read are fully read.
+        status, body = cli.execute('bogus')
+        check('non-200', status == 101 and body.startswith('Unknown request.'),
+              '{} {!r}'.format(status, body))
+        status, body = module._varnishadm('fake', cli, 'bogus')
+        check('non-200 (_varnishadm)', status == 101, '{} {!r}'.format(status, body))
+        status, body = cli.execute('big')
+        check('long body', status == 200 and body == 'x' * 100000, str(len(body)))
+
+        # A truncated response fails, and _varnishadm() closes the connection
+        # so the next command reconnects (and authenticates again).
+        check('truncated', raises(cli.execute, 'truncate') is not None)
+        cli.close()
+        status, body = cli.execute('pid', '-j')
+        check('reconnect', status == 200, '{} {!r}'.format(status, body))
+        cli.close()
+
+        # Authentication failures: wrong secret, missing secret, and no
+        # further connection attempts once the handshake failed.
+        cli = module.VarnishCLI([server.address], b'wrong\n')
+        error = raises(cli.connect)
+        check('wrong secret', error is not None and '107' in error, repr(error))
+        error = raises(cli.connect)
+        check('wrong secret (no retry)', error == 'Failed to connect to the CLI', repr(error))
+        error = raises(module.VarnishCLI([server.address]).connect)
+        check('missing secret', error is not None and 'no secret' in error, repr(error))
+
+        # No -S: the 200 banner is accepted without authentication.
+        cli = module.VarnishCLI([unauthenticated.address])
+        status, body = cli.execute('pid', '-j')
+        check('no auth', status == 200, '{} {!r}'.format(status, body))
+        cli.close()
+
+        # Unreachable addresses are skipped in order.
+        cli = module.VarnishCLI([('127.0.0.1', '1'), server.address], secret)
+        status, body = cli.execute('pid', '-j')
+        check('fallback address', status == 200, '{} {!r}'.format(status, body))
+        cli.close()
+
+        # -T & -S are located in the 'Arg' segments of the management VSM.
+        workdir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(workdir, '_.vsm_mgt'))
+            with open(os.path.join(workdir, 'secret'), 'wb') as fd:
+                fd.write(secret)
+            arguments = [
+                ('-T', '{} {}\n'.format(*server.address).encode('utf-8')),
+                ('-S', os.path.join(workdir, 'secret').encode('utf-8')),
+            ]
+            blob, index = b'', []
+            for ident, value in arguments:
+                segment = value + b'\0'
+                index.append('+ _.Arg {} {} Arg {}'.format(len(blob), len(segment), ident))
+                blob += segment
+            with open(os.path.join(workdir, '_.vsm_mgt', '_.Arg'), 'wb') as fd:
+                fd.write(blob)
+            with open(os.path.join(workdir, '_.vsm_mgt', '_.index'), 'w') as fd:
+                fd.write('\n'.join(index) + '\n')
+            cli = module._cli(workdir)
+            check('from_vsm', cli is not None)
+            if cli is not None:
+                status, body = cli.execute('pid', '-j')
+                check('from_vsm', status == 200, '{} {!r}'.format(status, body))
+                cli.close()
+        finally:
+            shutil.rmtree(workdir)
+    except (IOError, OSError, ValueError) as e:
+        failures.append('unexpected error: {}'.format(e))
+    finally:
+        server.shutdown()
+        unauthenticated.shutdown()
+    return failures
+
+
+###############################################################################
+## CGROUP
+###############################################################################
+
+CGROUP_ITEMS = {
+    'PRESSURE.cpu.some_avg10': (1.5, 'gauge'),
+    'PRESSURE.cpu.some_avg300': (0.25, 'gauge'),
+    'PRESSURE.cpu.some_total': (1.234567, 'counter'),
+    'PRESSURE.cpu.full_total': (0.0, 'counter'),
+    'PRESSURE.memory.full_avg60': (0.1, 'gauge'),
+    'PRESSURE.io.some_total': (5.5, 'counter'),
+    'PRESSURE.io.full_avg10': (3.0, 'gauge'),
+    'CGROUP_MEMORY.current': (1073741824, 'gauge'),
+    'CGROUP_MEMORY.anon': (536870912, 'gauge'),
+    'CGROUP_MEMORY.file_dirty': (8192, 'gauge'),
+    'CGROUP_MEMORY.pgmajfault': (12, 'counter'),
+    'CGROUP_MEMORY.workingset_refault_file': (50, 'counter'),
+    'CGROUP_IO.sda.rbytes': (1048576, 'counter'),
+    'CGROUP_IO.sda.wios': (512, 'counter'),
+    'CGROUP_IO.259:1.rbytes': (4096, 'counter'),
+}
+
+# Scenarios: (name, cgroup version, missing files, expected item prefixes).
+CGROUP_SCENARIOS = (
+    ('v2', 2, (), ('PRESSURE.', 'CGROUP_MEMORY.', 'CGROUP_IO.')),
+    ('v2 without PSI', 2, ('cpu.pressure', 'memory.pressure', 'io.pressure'),
+     ('CGROUP_MEMORY.', 'CGROUP_IO.')),
+    ('v2 without memory & io controllers', 2,
+     ('memory.current', 'memory.stat', 'io.stat'), ('PRESSURE.',)),
+    ('v2 without files', 2, tuple(benchmark.CGROUP_FILES), ()),
+    ('v1', 1, (), ()),
+    ('no /proc/<pid>/cgroup', 2, ('cgroup',), ()),
+)
+
+
+def cgroup_check(module):
+    # Run _cgroup_stats() on fake cgroup trees (see benchmark.cgroup()):
+    # cgroup v2 with all, some or none of the files, cgroup v1 and a process
+    # without cgroup file. Returns a list of failures.
+    failures = []
+    types = {'counter': module.TYPE_COUNTER, 'gauge': module.TYPE_GAUGE}
+    proc_dir, sys_dir = module.PROC_DIR, module.SYS_DIR
+    for name, version, missing, prefixes in CGROUP_SCENARIOS:
+        path = tempfile.mkdtemp()
+        try:
+            benchmark.cgroup(path, 1234, version, missing)
+            module.PROC_DIR = os.path.join(path, 'proc')
+            module.SYS_DIR = os.path.join(path, 'sys')
+            messages = []
+            stats = module.Stats(
+                module.ITEMS, module.SUBJECTS, re.compile(r'^(?!)'), messages.append)
+            module._cgroup_stats(stats, 1234)
+        finally:
+            module.PROC_DIR, module.SYS_DIR = proc_dir, sys_dir
+            shutil.rmtree(path)
+
+        items = dict((item.name, item) for item in stats.items)
+        for message in messages:
+            failures.append('{}: unexpected message: {}'.format(name, message))
+        for item in sorted(items):
+            if not item.startswith(prefixes) or (
+                    item.startswith('CGROUP_IO.') and
+                    item.rsplit('.', 1)[1] not in module.CGROUP_IO_STATS):
+                failures.append('{}: unexpected item {}'.format(name, item))
+        for item, (value, type) in sorted(CGROUP_ITEMS.items()):
+            if not item.startswith(prefixes):
+                continue
+            if item not in items:
+                failures.append('{}: missing item {}'.format(name, item))
+            elif (items[item].value, items[item].type) != (value, types[type]):
+                failures.append('{}: {} is {!r} ({}), expected {!r} ({})'.format(
+                    name, item, items[item].value, items[item].type, value, types[type]))
+        if 'CGROUP_IO.' in prefixes and stats.subjects('devices') != set(['sda', '259:1']):
+            failures.append('{}: devices {!r}'.format(name, stats.subjects('devices')))
+    return failures
+
+
+###############################################################################
+## SEND
+###############################################################################
+
+class FakeTrapperHandler(socketserver.BaseRequestHandler):
+    '''
+    Emulates a Zabbix trapper: reads a single 'ZBXD\\x01' framed request,
+    records it (or the framing error) and answers using the next queued
+    response: 'success' / 'failed' (counting the request values as processed
+    or failed), 'partial' (a success with one failed value) or raw bytes.
+    '''
+
+    def handle(self):
+        data = b''
+        while True:
+            chunk = self.request.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+            if len(data) >= 13 and len(data) >= 13 + struct.unpack('<Q', data[5:13])[0]:
+                break
+        if data[:5] != b'ZBXD\x01':
+            self.server.requests.append('bad header {!r}'.format(data[:5]))
+            return
+        length = struct.unpack('<Q', data[5:13])[0]
+        if len(data) != 13 + length:
+            self.server.requests.append('bad length {} != {}'.format(length, len(data) - 13))
+            return
+        request = json.loads(data[13:].decode('utf-8'))
+        self.server.requests.append(request)
+
+        response = self.server.responses.pop(0) if self.server.responses else 'success'
+        if not isinstance(response, bytes):
+            count = len(request.get('data', []))
+            processed, failed = {
+                'success': (count, 0),
+                'partial': (count - 1, 1),
+                'failed': (0, count),
+            }[response]
+            response = json.dumps({
+                'response': 'failed' if response == 'failed' else 'success',
+                'info': 'processed: {}; failed: {}; total: {}; seconds spent: 0.000042'.format(
+                    processed, failed, count),
+            }).encode('utf-8')
+            response = b'ZBXD\x01' + struct.pack('<Q', len(response)) + response
+        self.request.sendall(response)
+
+
+class FakeTrapperServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, responses):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), FakeTrapperHandler)
+        self.responses = list(responses)
+        self.requests = []
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def address(self):
+        return '{}:{}'.format(*self.server_address)
+
+
+# Scenarios: (name, queued responses, expected summary). 7 values are sent in
+# batches of 3.
+SEND_SCENARIOS = (
+    ('success', (), {'processed': 7, 'failed': 0, 'total': 7}),
+    ('unknown items', ('partial', 'success', 'partial'),
+     {'processed': 5, 'failed': 2, 'total': 7}),
+    ('rejected batch', ('success', 'failed'), {'processed': 4, 'failed': 3, 'total': 7}),
+    ('invalid response', (b'HTTP/1.0 400 Bad Request\r\n\r\n',),
+     {'processed': 4, 'failed': 3, 'total': 7}),
+)
+
+
+def send_check(module):
+    # Run the 'send' command against a fake Zabbix trapper: framing of
+    # requests, batching of values (keys, host & timestamps) and parsing of
+    # the processed / failed counts of responses (also for rejected batches,
+    # invalid responses and unreachable servers). Returns a list of failures.
+    failures = []
+    names = ['MAIN.counter{}'.format(i) for i in range(7)]
+    stats = module.Stats(module.ITEMS, module.SUBJECTS, re.compile(r'^(?!)'))
+    stats.timestamp = 1767225600.25
+    for i, name in enumerate(names):
+        stats.add(module.Item(name, i * 10, module.TYPE_COUNTER))
+    expected = [
+        'varnish.stat["fake","{}"]'.format(name) for name in names]
+
+    collect_all = module._collect_all
+    module._collect_all = lambda options, subject=None: [('fake', stats)]
+    workdir = tempfile.mkdtemp()
+    try:
+        def send(server):
+            options = module._parser().parse_args([
+                '-i', 'fake', '-d', workdir, 'send', '--server', server,
+                '--host', 'varnish.example.com', '--batch-size', '3'])
+            stream = io.StringIO()
+            stderr, sys.stderr = sys.stderr, io.StringIO()
+            try:
+                module.send(options, stream)
+            finally:
+                sys.stderr = stderr
+            return json.loads(stream.getvalue())
+
+        for name, responses, summary in SEND_SCENARIOS:
+            server = FakeTrapperServer(responses)
+            try:
+                result = send(server.address)
+            finally:
+                server.shutdown()
+                server.server_close()
+            for request in server.requests:
+                if not isinstance(request, dict):
+                    failures.append('{}: {}'.format(name, request))
+            requests = [request for request in server.requests if isinstance(request, dict)]
+            if [len(request['data']) for request in requests] != [3, 3, 1]:
+                failures.append('{}: batches {!r}'.format(
+                    name, [len(request['data']) for request in requests]))
+            values = [value for request in requests for value in request['data']]
+            if [value['key'] for value in values] != expected:
+                failures.append('{}: keys {!r}'.format(name, [value['key'] for value in values]))
+            for request in requests:
+                if request.get('request') != 'sender data':
+                    failures.append('{}: request {!r}'.format(name, request.get('request')))
+            for value in values:
+                if (value['host'], value['clock'], value['ns']) != (
+                        'varnish.example.com', 1767225600, 250000000):
+                    failures.append('{}: value {!r}'.format(name, value))
+                    break
+            if result != summary:
+                failures.append('{}: summary {!r}, expected {!r}'.format(name, result, summary))
+
+        # Unreachable server: no further batches are attempted and all values
+        # are reported as failed.
+        server = FakeTrapperServer(())
+        address = server.address
+        server.shutdown()
+        server.server_close()
+        result = send(address)
+        if result != {'processed': 0, 'failed': 7, 'total': 7}:
+            failures.append('unreachable: summary {!r}'.format(result))
+    except (IOError, OSError, ValueError) as e:
+        failures.append('unexpected error: {}'.format(e))
+    finally:
+        module._collect_all = collect_all
+        shutil.rmtree(workdir)
+    return failures
+
+
+###############################################################################
+## MAIN
+###############################################################################
+
+def main():
+    # Parse command line arguments.
+    parser = ArgumentParser(description='Check zabbix-varnish-cache.py.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparser = subparsers.add_parser(
+        'vsm-capture',
+        help='capture the VSM & varnishstat output of a live instance')
+    subparser.add_argument('-n', dest='instance', type=str, default='')
+    subparser.add_argument('path', type=str)
+    subparser = subparsers.add_parser(
+        'vsm',
+        help='check the VSM reader against captures (defaults to the ones in'
+             ' \'benchmarks/vsm\')')
+    subparser.add_argument('paths', type=str, nargs='*')
+    subparser = subparsers.add_parser(
+        'cli',
+        help='check the built-in CLI client against a fake varnishd CLI')
+    subparser = subparsers.add_parser(
+        'cgroup',
+        help='check cgroup stats against fake cgroup v1 / v2 trees')
+    subparser = subparsers.add_parser(
+        'send',
+        help='check the \'send\' command against a fake Zabbix trapper')
+    options = parser.parse_args()
+
+    # Run checks.
+    module = load()
+    if options.command == 'vsm-capture':
+        count = vsm_capture(module, options.instance, options.path)
+        sys.stdout.write('vsm-capture: {} counters\n'.format(count))
+    elif options.command == 'vsm':
+        paths = options.paths or [
+            os.path.join(VSM_CAPTURES, name) for name in sorted(os.listdir(VSM_CAPTURES))]
+        failed = False
+        for path in paths:
+            failures = vsm_check(module, path)
+            for failure in failures:
+                sys.stdout.write('vsm {}: {}\n'.format(path, failure))
+            sys.stdout.write('vsm {}: {}\n'.format(path, 'FAILED' if failures else 'OK'))
+            failed = failed or bool(failures)
+        sys.exit(1 if failed else 0)
+    elif options.command in ('cli', 'cgroup', 'send'):
+        failures = globals()[options.command + '_check'](module)
+        for failure in failures:
+            sys.stdout.write('{}: {}\n'.format(options.command, failure))
+        sys.stdout.write('{}: {}\n'.format(
+            options.command, 'FAILED' if failures else 'OK'))
+        sys.exit(1 if failures else 0)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
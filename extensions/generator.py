@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+'''
+:url: https://github.com/allenta/zabbix-template-for-varnish-cache
+:copyright: (c) 2015-2026 by Allenta Consulting S.L. <info@allenta.com>.
+:license: BSD, see LICENSE.txt for more details.
+
+Renders the Jinja2 skeleton for several Zabbix versions at once: the template
+is parsed & compiled just once (compiled code is shared through a bytecode
+cache), versions are rendered concurrently on a pool of processes, and
+versions whose inputs didn't change since the previous build are skipped.
+Usage example:
+
+    $ python3 -m extensions.generator -v 6.0,7.4 -D release=trunk
+'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import hashlib
+import json
+import os
+import sys
+from argparse import ArgumentParser
+
+import jinja2
+
+TEMPLATE = 'template-app-varnish-cache.j2'
+
+VERSIONS = ('6.0', '6.2', '6.4', '7.0', '7.2', '7.4')
+
+OUTPUT = 'template-app-varnish-cache-{version}.xml'
+
+CACHE_DIR = '.template-cache'
+
+
+def generate(options):
+    # Initializations.
+    environment = _environment(options.cache_dir)
+    template = environment.get_template(options.template)
+    manifest_path = os.path.join(options.cache_dir, 'manifest.json')
+    try:
+        with open(manifest_path, 'r') as fd:
+            manifest = json.load(fd)
+    except (IOError, ValueError):
+        manifest = {}
+
+    # Find out versions whose output is missing or outdated. Inputs are the
+    # template, the Jinja2 extension, the version & all other variables.
+    with open(template.filename, 'rb') as fd:
+        template_digest = hashlib.sha1(fd.read()).hexdigest()
+    with open(os.path.join(os.path.dirname(__file__), 'zabbix.py'), 'rb') as fd:
+        extension_digest = hashlib.sha1(fd.read()).hexdigest()
+    tasks = []
+    for version in options.versions:
+        variables = dict(options.variables, version=version)
+        output = options.output.format(**variables)
+        digest = hashlib.sha1(json.dumps(
+            [template_digest, extension_digest, variables],
+            sort_keys=True).encode('utf-8')).hexdigest()
+        if not options.force and manifest.get(output) == digest and os.path.exists(output):
+            sys.stdout.write('{}: unchanged\n'.format(output))
+        else:
+            tasks.append((output, digest, variables))
+
+    # Render & write templates concurrently.
+    if tasks:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(
+                max_workers=min(options.workers, len(tasks)),
+                initializer=_initialize,
+                initargs=(options.cache_dir, options.template)) as executor:
+            futures = [
+                (output, digest, executor.submit(_render, output, variables))
+                for output, digest, variables in tasks]
+            failed = False
+            for output, digest, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    sys.stderr.write('{}: failed ({})\n'.format(output, e))
+                    manifest.pop(output, None)
+                    failed = True
+                else:
+                    sys.stdout.write('{}: rendered\n'.format(output))
+                    manifest[output] = digest
+
+        # Persist inputs of all successful renders.
+        tmp = manifest_path + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(manifest, fd, sort_keys=True, indent=2)
+        os.rename(tmp, manifest_path)
+        if failed:
+            sys.exit(1)
+
+
+_TEMPLATE = None
+
+
+def _initialize(cache_dir, name):
+    # Load the (already compiled) template once per worker process.
+    global _TEMPLATE
+    _TEMPLATE = _environment(cache_dir).get_template(name)
+
+
+def _render(output, variables):
+    tmp = output + '.tmp'
+    with open(tmp, 'w') as fd:
+        for chunk in _TEMPLATE.generate(**variables):
+            fd.write(chunk)
+    os.rename(tmp, output)
+
+
+def _environment(cache_dir):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader('.'),
+        undefined=jinja2.StrictUndefined,
+        extensions=['extensions.zabbix.ZabbixExtension'],
+        bytecode_cache=jinja2.FileSystemBytecodeCache(cache_dir),
+        keep_trailing_newline=True)
+
+
+def _define(value):
+    # Parse a 'name=value' template variable.
+    name, separator, value = value.partition('=')
+    if not separator or not name:
+        raise ValueError(value)
+    return name, value
+
+
+def main():
+    # Parse command line arguments.
+    parser = ArgumentParser(description='Generate Zabbix templates.')
+    parser.add_argument(
+        '-t', '--template', dest='template',
+        type=str, default=TEMPLATE,
+        help='Jinja2 skeleton (defaults to "{}")'.format(TEMPLATE))
+    parser.add_argument(
+        '-v', '--versions', dest='versions',
+        type=lambda value: [version.strip() for version in value.split(',')],
+        default=list(VERSIONS),
+        help='comma-delimited list of Zabbix versions (defaults to all'
+             ' supported versions)')
+    parser.add_argument(
+        '-D', '--define', dest='variables',
+        type=_define, action='append', default=[],
+        help='template variable (e.g. \'release=trunk\'); can be used'
+             ' multiple times')
+    parser.add_argument(
+        '-o', '--output', dest='output',
+        type=str, default=OUTPUT,
+        help='output file name, where template variables can be used (defaults'
+             ' to "{}")'.format(OUTPUT))
+    parser.add_argument(
+        '-w', '--workers', dest='workers',
+        type=int, default=os.cpu_count() or 1,
+        help='maximum number of versions rendered concurrently (defaults to'
+             ' the number of CPUs)')
+    parser.add_argument(
+        '-c', '--cache-dir', dest='cache_dir',
+        type=str, default=CACHE_DIR,
+        help='directory where compiled templates and inputs of previous builds'
+             ' are kept (defaults to "{}")'.format(CACHE_DIR))
+    parser.add_argument(
+        '-f', '--force', dest='force',
+        action='store_true', default=False,
+        help='render all versions, even if their inputs didn\'t change')
+    options = parser.parse_args()
+    options.variables = dict(options.variables)
+
+    # Generate templates.
+    generate(options)
+
+
+if __name__ == '__main__':
+    main()
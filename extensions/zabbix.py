@@ -8,24 +8,31 @@
 
 import binascii
 import hashlib
+import weakref
+from jinja2 import pass_context
 from jinja2.ext import Extension
 
 
 class ZabbixExtension(Extension):
-    uuids = set()
-
     def __init__(self, environment):
         super(ZabbixExtension, self).__init__(environment)
         environment.filters['zuuid'] = self._zuuid
 
-    def _zuuid(self, seed):
+        # UUIDs generated so far, tracked per render (i.e. per context), so
+        # the same template can be rendered several times by the same
+        # environment.
+        self.uuids = weakref.WeakKeyDictionary()
+
+    @pass_context
+    def _zuuid(self, context, seed):
         data = bytearray(hashlib.md5(seed.encode('utf-8')).digest())
         data[6] = data[6] & 0x0f | 0x40
         data[8] = data[8] & 0x3f | 0x80
         uuid = binascii.hexlify(data).decode('utf-8')
 
-        if uuid in self.uuids:
+        uuids = self.uuids.setdefault(context, set())
+        if uuid in uuids:
             raise Exception("Duplicated seed/UUID: '{}' ➙ {}".format(seed, uuid))
-        self.uuids.add(uuid)
+        uuids.add(uuid)
 
         return uuid
@@ -8,13 +8,17 @@
 '''
 
 from __future__ import absolute_import, division, print_function, unicode_literals
+import bisect
+import io
 import json
+import os
 import re
-import socket
-import subprocess
+import stat
 import sys
-from argparse import ArgumentParser, ArgumentTypeError
-from resource import getpagesize
+import threading
+import time
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from resource import getpagesize, getrusage, RUSAGE_SELF
 
 TYPE_COUNTER = 1
 TYPE_GAUGE = 2
@@ -334,93 +338,438 @@ ITEMS = (
     #   - Failed connection attempts: fail_eacces, fail_eaddrnotavail, fail_econnrefused, fail_enetunreach, fail_etimedout, fail_other.
     #   - Bytes sent to backend: pipe_out, pipe_hdrbytes, bereq_hdrbytes, bereq_bodybytes.
     #   - Bytes received from backend: pipe_in, beresp_hdrbytes, beresp_bodybytes.
-    r'VBE\..+\.(?:bereq_bodybytes|bereq_hdrbytes|beresp_bodybytes|beresp_hdrbytes|busy|conn|fail|fail_eacces|fail_eaddrnotavail|fail_econnrefused|fail_enetunreach|fail_etimedout|fail_other|happy|helddown|pipe_hdrbytes|pipe_in|pipe_out|req|unhealthy|healthy)',
+    r'VBE\..+\.(?:bereq_bodybytes|bereq_hdrbytes|beresp_bodybytes|beresp_hdrbytes|busy|conn|fail|fail_eacces|fail_eaddrnotavail|fail_econnrefused|fail_enetunreach|fail_etimedout|fail_other|happy|helddown|pipe_hdrbytes|pipe_in|pipe_out|req|unhealthy|healthy|latency_count|latency_max|latency_p50|latency_p90|latency_p99)',
 )
 
+# Rewrites & subjects patterns are compiled (once per process) by the
+# classifier, and only when a name they may match is found.
 REWRITES = [
     # KVSTORE.vha6_stats.boot.foo -> VHA6.foo.
-    (re.compile(r'^KVSTORE\.vha6_stats\.[^\.]+'), r'VHA6'),
+    (r'^KVSTORE\.vha6_stats\.[^\.]+', r'VHA6'),
     # KVSTORE.counters.boot.foo -> COUNTER.foo.
-    (re.compile(r'^KVSTORE\.counters\.[^\.]+'), r'COUNTER'),
+    (r'^KVSTORE\.counters\.[^\.]+', r'COUNTER'),
     # MSE.main.foo -> STG.MSE.main.foo. Beware MSE4 doesn't follow the same
     # pattern (i.e. <type>.<name>.<metric>) because on MSE4-enabled VCPs a
     # single MSE4 store can be used.
-    (re.compile(r'^((?:MSE|SMA|SMF)\..+)$'), r'STG.\1'),
+    (r'^((?:MSE|SMA|SMF)\..+)$', r'STG.\1'),
     # MSE4_CAT.(foo.bar).baz -> MSE4_CAT.foo.bar.baz
-    (re.compile(r'^MSE4_CAT\.\(([^\)]+)\)\.'), r'MSE4_CAT.\1.'),
+    (r'^MSE4_CAT\.\(([^\)]+)\)\.', r'MSE4_CAT.\1.'),
     # VBE.boot.foo.bar.baz -> VBE.foo.bar.baz
-    (re.compile(r'^VBE\.[^\.]+'), r'VBE'),
+    (r'^VBE\.[^\.]+', r'VBE'),
     # VBE.goto.0000003f.(1.2.3.4).(http://foo.com:80).(ttl:10.000000) -> VBE.goto.(1.2.3.4).(http://foo.com:80).(ttl:10.000000)
-    (re.compile(r'^VBE\.goto\.[0-9a-f]+'), r'VBE.goto'),
+    (r'^VBE\.goto\.[0-9a-f]+', r'VBE.goto'),
 ]
 
 EXCLUSIONS = r'^ACCG\.(?!std\.)'
 
+VSM_FLAGS = {
+    'counter': 'c',
+    'gauge': 'g',
+    'bitmap': 'b',
+}
+
+CLASSIFIER_MEMO_SIZE = 100000
+
+VARNISHSTAT_GLOBS_PER_STEM = 8
+
+METRIC_TYPES = {
+    TYPE_COUNTER: 'counter',
+    TYPE_GAUGE: 'gauge',
+    TYPE_OTHER: 'untyped',
+}
+
+SOCKET_TIMEOUT = 10
+
+STATE_DIR = '/var/lib/zabbix-varnish-cache'
+
+PROC_DIR = '/proc'
+
+SYS_DIR = '/sys'
+
+CGROUP_MEMORY_STATS = {
+    'anon': TYPE_GAUGE,
+    'file': TYPE_GAUGE,
+    'shmem': TYPE_GAUGE,
+    'slab': TYPE_GAUGE,
+    'sock': TYPE_GAUGE,
+    'file_dirty': TYPE_GAUGE,
+    'file_writeback': TYPE_GAUGE,
+    'pgfault': TYPE_COUNTER,
+    'pgmajfault': TYPE_COUNTER,
+    'pgscan': TYPE_COUNTER,
+    'pgsteal': TYPE_COUNTER,
+    'workingset_refault_anon': TYPE_COUNTER,
+    'workingset_refault_file': TYPE_COUNTER,
+}
+
+# 'io.stat' fields collected per block device (all of them counters). Fields
+# added by io.cost / io.latency controllers (e.g. 'cost.vrate', 'depth=max')
+# are ignored.
+CGROUP_IO_STATS = ('rbytes', 'wbytes', 'rios', 'wios', 'dbytes', 'dios')
+
+# Upper bounds (in seconds, log-spaced) of latency histogram buckets, plus an
+# implicit +Inf bucket.
+LATENCY_BUCKETS = (
+    0.0001, 0.0002, 0.0005,
+    0.001, 0.002, 0.005,
+    0.01, 0.02, 0.05,
+    0.1, 0.2, 0.5,
+    1, 2, 5,
+    10, 20, 50,
+)
+
+# 'Timestamp' records folded into latency histograms: histogram name (None
+# for per backend histograms) & position of the duration in the record (4 for
+# time since the start of the transaction, 5 for time since the previous
+# timestamp).
+LATENCY_TIMESTAMPS = {
+    b'Resp:': ('resp', 4),
+    b'Process:': ('process', 4),
+    b'Fetch:': ('fetch', 5),
+    b'Beresp:': (None, 4),
+}
+
+LATENCY_BACKENDS_MAX = 1000
+
+# Subject types whose cardinality can be limited using --top: suffix of the
+# counter used to rank subjects by activity (None to rank them by the sum of
+# all their counters), and whether the first component of subject values
+# (e.g. the namespace of accounting keys) is kept when folding them.
+TOP_SUBJECTS = {
+    'accountings': ('client_req_count', True),
+    'backends': ('req', False),
+    'counters': (None, False),
+}
+
+TOP_OTHER = '__other__'
+
+# Number of consecutive executions a subject kept by --top must rank out of
+# the N most active ones before being folded into the synthetic subject.
+TOP_EVICTIONS = 5
+
+# Number of seconds 'MAIN.uptime' may grow less than the wall clock between
+# two executions using --rates before assuming the child process restarted.
+RATES_UPTIME_SLACK = 5
+
+AGGREGATE_INSTANCE = '_all'
+
+# Items of the synthetic --aggregate instance that can't be summed: the
+# maximum of all instances is used for uptimes, latency percentiles and
+# pressure averages, and collector costs (which only describe the collection
+# of each instance) are discarded.
+AGGREGATE_MAXIMUMS = re.compile(
+    r'^(?:(?:MGT|MAIN)\.uptime|LATENCY\.[^\.]+\.(?:p\d+|max)|'
+    r'VBE\..+\.latency_(?:p\d+|max)|PRESSURE\..+_avg\d+)$')
+AGGREGATE_DISCARDED = re.compile(r'^SELF\.')
+
+# Rewrites of (already rewritten) names of dynamic backends used by
+# --rollup-backends.
+BACKEND_ROLLUPS = [
+    # goto.(1.2.3.4).(http://foo.com:80).(ttl:10.000000) -> goto.(http://foo.com:80)
+    (re.compile(r'^goto\.\([^\)]*\)\.(\([^\)]*\))(?:\..*)?$'), r'goto.\1'),
+    # foo(1.2.3.4:80) (dynamic VMOD) -> foo
+    (re.compile(r'^([^\(\)]+)\([^\)]*\)$'), r'\1'),
+]
+
 SUBJECTS = {
     'items': None,
-    'counters': re.compile(r'^COUNTER\.(.+)$'),
-    'accountings': re.compile(r'^ACCG\.([^\.]+\.[^\.]+)\.[^\.]+$'),
-    'mse_books': re.compile(r'^MSE_BOOK\.(.+)\.[^\.]+$'),
-    'mse_stores': re.compile(r'^MSE_STORE\.(.+)\.[^\.]+$'),
-    'mse4_books': re.compile(r'^MSE4_BOOK\.(.+)\.[^\.]+$'),
-    'mse4_stores': re.compile(r'^MSE4_STORE\.(.+)\.[^\.]+$'),
-    'mse4_categories': re.compile(r'^MSE4_CAT\.(.+)\.[^\.]+$'),
-    'storages': re.compile(r'^STG\.(.+)\.[^\.]+$'),
-    'backends': re.compile(r'^VBE\.(.+)\.[^\.]+$'),
+    'counters': r'^COUNTER\.(.+)$',
+    'accountings': r'^ACCG\.([^\.]+\.[^\.]+)\.[^\.]+$',
+    'mse_books': r'^MSE_BOOK\.(.+)\.[^\.]+$',
+    'mse_stores': r'^MSE_STORE\.(.+)\.[^\.]+$',
+    'mse4_books': r'^MSE4_BOOK\.(.+)\.[^\.]+$',
+    'mse4_stores': r'^MSE4_STORE\.(.+)\.[^\.]+$',
+    'mse4_categories': r'^MSE4_CAT\.(.+)\.[^\.]+$',
+    'storages': r'^STG\.(.+)\.[^\.]+$',
+    'backends': r'^VBE\.(.+)\.[^\.]+$',
+    'threads': r'^THREADS\.(.+)\.[^\.]+$',
+    'devices': r'^CGROUP_IO\.(.+)\.[^\.]+$',
 }
 
 ###############################################################################
 ## 'stats' COMMAND
 ###############################################################################
 
-def stats(options):
+def stats(options, stream=sys.stdout):
     # Initializations.
-    result = {}
-
-    # Build master item contents.
-    for instance in options.varnish_instances.split(','):
-        instance = instance.strip()
-        stats = _stats(instance, options.exclusions)
-        for item in stats.items:
-            result['%(instance)s.%(name)s' % {
-                'instance': _safe_zabbix_string(instance),
-                'name': _safe_zabbix_string(item.name),
-            }] = item.value
+    separator = '{'
+
+    # Render master item contents, item by item. When requested, the size of
+    # the output of each instance is included as a last 'SELF.output_bytes'
+    # item (JSON output is pure ASCII, so characters are bytes).
+    for instance, stats in _collect_all(options):
+        size = 0
+        for item in _emitted(options, instance, stats):
+            chunk = '%(separator)s%(name)s:%(value)s' % {
+                'separator': separator,
+                'name': json.dumps('%(instance)s.%(name)s' % {
+                    'instance': _safe_zabbix_string(instance),
+                    'name': _safe_zabbix_string(item.name),
+                }),
+                'value': json.dumps(item.value),
+            }
+            stream.write(chunk)
+            size += len(chunk)
+            separator = ','
+        if options.self_stats:
+            stream.write('%(separator)s%(name)s:%(value)d' % {
+                'separator': separator,
+                'name': json.dumps('%(instance)s.SELF.output_bytes' % {
+                    'instance': _safe_zabbix_string(instance),
+                }),
+                'value': size,
+            })
+            separator = ','
 
-    # Render output.
-    sys.stdout.write(json.dumps(result, separators=(',', ':')))
+    # Done!
+    stream.write('}' if separator == ',' else '{}')
 
 
 ###############################################################################
 ## 'discover' COMMAND
 ###############################################################################
 
-def discover(options):
+def discover(options, stream=sys.stdout):
     # Initializations.
     discovery = {
         'data': [],
     }
 
-    # Build Zabbix discovery input.
-    for instance in options.varnish_instances.split(','):
-        instance = instance.strip()
-        if options.subject == 'items':
-            discovery['data'].append({
-                '{#LOCATION}': instance,
-                '{#LOCATION_ID}': _safe_zabbix_string(instance),
+    # Build Zabbix discovery input. 'all' collects stats just once and returns
+    # discovery data for every subject type, keyed by subject type (i.e.
+    # suitable as the master item of dependent discovery rules).
+    if options.subject == 'all':
+        results = _collect_all(options)
+        discovery = dict(
+            (subject, _discovery(options, subject, results)) for subject in SUBJECTS)
+    elif options.subject == 'items':
+        discovery['data'] = _discovery(options, options.subject, None)
+    else:
+        discovery['data'] = _discovery(
+            options, options.subject, _collect_all(options, options.subject))
+
+    # Render output.
+    stream.write(json.dumps(discovery, sort_keys=True, indent=2))
+
+
+###############################################################################
+## 'send' COMMAND
+###############################################################################
+
+def send(options, stream=sys.stdout):
+    # Initializations.
+    host, port = _address(options.server, 10051)
+    if options.host is None:
+        import socket
+        options.host = socket.gethostname()
+    summary = {
+        'processed': 0,
+        'failed': 0,
+        'total': 0,
+    }
+    batch = []
+    unsent = {
+        'error': None,
+        'count': 0,
+    }
+
+    def flush():
+        # Send current batch using the Zabbix sender protocol & accumulate
+        # results reported by the trapper. Once the server can't be reached
+        # there's no point in trying again: remaining batches are just counted
+        # and reported as a whole at the end.
+        if unsent['error'] is None:
+            try:
+                response = _zabbix_send(host, port, batch)
+                info = dict(
+                    (key, int(value))
+                    for key, value in re.findall(
+                        r'(processed|failed|total): (\d+)', response.get('info', '')))
+                if response.get('response') != 'success':
+                    raise ValueError(response.get('info', 'unexpected response'))
+            except (IOError, OSError) as e:
+                unsent['error'] = e
+            except ValueError as e:
+                sys.stderr.write('Failed to send {} values to {}:{}: {}\n'.format(
+                    len(batch), host, port, e))
+                info = {'failed': len(batch), 'total': len(batch)}
+            if unsent['error'] is None:
+                for key in summary:
+                    summary[key] += info.get(key, 0)
+        if unsent['error'] is not None:
+            unsent['count'] += len(batch)
+        del batch[:]
+
+    # Push every item as a trapper value, with the collection timestamp.
+    for instance, stats in _collect_all(options):
+        clock, ns = int(stats.timestamp), int((stats.timestamp % 1) * 1e9)
+        for item in _emitted(options, instance, stats):
+            batch.append({
+                'host': options.host,
+                'key': 'varnish.stat["%(instance)s","%(name)s"]' % {
+                    'instance': _safe_zabbix_string(instance),
+                    'name': _safe_zabbix_string(item.name),
+                },
+                'value': str(item.value),
+                'clock': clock,
+                'ns': ns,
             })
-        else:
-            stats = _stats(instance, options.exclusions)
-            for subject in stats.subjects(options.subject):
-                discovery['data'].append({
-                    '{#LOCATION}': instance,
-                    '{#LOCATION_ID}': _safe_zabbix_string(instance),
-                    '{#SUBJECT}': subject,
-                    '{#SUBJECT_ID}': _safe_zabbix_string(subject),
-                })
+            if len(batch) >= options.batch_size:
+                flush()
+    if batch:
+        flush()
+    if unsent['error'] is not None:
+        sys.stderr.write('Failed to send {} values to {}:{}: {}\n'.format(
+            unsent['count'], host, port, unsent['error']))
+        summary['failed'] += unsent['count']
+        summary['total'] += unsent['count']
 
     # Render output.
-    sys.stdout.write(json.dumps(discovery, sort_keys=True, indent=2))
+    stream.write(json.dumps(summary, sort_keys=True))
+
+
+###############################################################################
+## 'exporter' COMMAND
+###############################################################################
+
+def exporter(options, stream=sys.stdout):
+    # Deferred imports: only the long-running exporter needs them.
+    import signal
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    # Scrapes within the same window share a single collection.
+    options.max_age = max(options.max_age, options.scrape_window)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            try:
+                results = _collect_all(options)
+            except Exception as e:
+                self.send_error(500, 'Failed to collect stats: {}'.format(e))
+                return
+
+            # Render output in chunks, without building the whole body.
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.end_headers()
+            chunk = []
+            for line in _metrics(results):
+                chunk.append(line)
+                if len(chunk) >= 1024:
+                    self.wfile.write(''.join(chunk).encode('utf-8'))
+                    chunk = []
+            self.wfile.write(''.join(chunk).encode('utf-8'))
+
+        def log_message(self, format, *args):
+            pass
+
+    # Start feeding latency histograms (if enabled) & serving requests.
+    for instance in _instances(options):
+        _latencies(instance, options)
+    server = ThreadingHTTPServer(_address(options.listen, 9131), Handler)
+    server.daemon_threads = True
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+###############################################################################
+## 'serve' COMMAND
+###############################################################################
+
+def serve(options, stream=sys.stdout):
+    # Deferred imports: only the long-running collector needs them.
+    import signal
+    import socketserver
+
+    # Initializations.
+    parser = _parser()
+    instances = _instances(options)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            # Requests are the command line arguments of a 'stats' or
+            # 'discover' execution, which are executed here reusing snapshots
+            # collected by this process when they are not older than two
+            # collection intervals. Clients may be less privileged than the
+            # daemon, so only the command, the subject and a subset of the
+            # daemon's instances are taken from the request: everything else
+            # (state directory, exclusions, caches, etc.) comes from the
+            # daemon's own options.
+            try:
+                request = json.loads(self.rfile.readline().decode('utf-8'))
+                arguments = parser.parse_args(request['argv'])
+                if arguments.command not in ('stats', 'discover'):
+                    raise ValueError('Unsupported command: {}'.format(
+                        arguments.command))
+                requested = _instances(arguments)
+                unknown = [
+                    instance for instance in requested
+                    if instance not in instances]
+                if unknown:
+                    raise ValueError('Unknown instances: {}'.format(
+                        ', '.join(unknown)))
+                request_options = Namespace(**vars(options))
+                request_options.command = arguments.command
+                request_options.subject = getattr(arguments, 'subject', None)
+                request_options.varnish_instances = ','.join(requested)
+                request_options.socket = None
+                request_options.max_age = max(
+                    options.max_age, 2 * options.interval)
+                output = io.StringIO()
+                globals()[request_options.command](request_options, output)
+                response = 'OK\n' + output.getvalue()
+            except (Exception, SystemExit) as e:
+                response = 'ERROR\nFailed to process request: {}'.format(e)
+            self.wfile.write(response.encode('utf-8'))
+
+    def refresh():
+        # Periodically collect stats for all instances in the background, so
+        # requests are usually answered without waiting for varnishstat &
+        # varnishadm.
+        while True:
+            deadline = time.time() + options.interval
+            for instance in instances:
+                try:
+                    _store(instance, options, _stats(instance, options))
+                except Exception as e:
+                    sys.stderr.write('Failed to collect stats for instance "{}": {}\n'.format(
+                        instance, e))
+            time.sleep(max(0, deadline - time.time()))
+
+    # Remove any stale socket left behind by a previous execution.
+    try:
+        if stat.S_ISSOCK(os.stat(options.socket).st_mode):
+            os.unlink(options.socket)
+    except OSError:
+        pass
+
+    # Start feeding latency histograms (if enabled), collecting & serving
+    # requests.
+    for instance in instances:
+        _latencies(instance, options)
+    server = socketserver.ThreadingUnixStreamServer(options.socket, Handler)
+    server.daemon_threads = True
+    os.chmod(options.socket, options.socket_mode)
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(options.socket)
 
 
 ###############################################################################
@@ -433,6 +782,8 @@ class Item(object):
     value, type and subject (type & value).
     '''
 
+    __slots__ = ('_name', '_value', '_type', '_subject_type', '_subject_value')
+
     def __init__(
             self, name, value, type, subject_type=None, subject_value=None):
         # Set name and value.
@@ -462,13 +813,795 @@ class Item(object):
     def subject_value(self):
         return self._subject_value
 
-    def aggregate(self, value):
-        # Aggregate another value. Only counter and gauges can be aggregated.
-        # In any other case, mark this item's value as discarded.
-        if self.type in (TYPE_COUNTER, TYPE_GAUGE):
-            self._value += value
-        else:
-            self._value = None
+
+def _discovery(options, subject, results):
+    # Return the list of discovered LLD rows of a subject type, given a list
+    # of (instance, stats) pairs ('items' only depend on the instances).
+    data = []
+    if subject == 'items':
+        instances = _instances(options)
+        if options.aggregate:
+            instances.append(AGGREGATE_INSTANCE)
+        for instance in instances:
+            data.append({
+                '{#LOCATION}': instance,
+                '{#LOCATION_ID}': _safe_zabbix_string(instance),
+            })
+    else:
+        for instance, stats in results:
+            for value in stats.subjects(subject):
+                data.append({
+                    '{#LOCATION}': instance,
+                    '{#LOCATION_ID}': _safe_zabbix_string(instance),
+                    '{#SUBJECT}': value,
+                    '{#SUBJECT_ID}': _safe_zabbix_string(value),
+                })
+    return data
+
+
+def _instances(options):
+    # Return the list of instances, in order and without duplicates.
+    result = []
+    for instance in options.varnish_instances.split(','):
+        instance = instance.strip()
+        if instance not in result:
+            result.append(instance)
+    return result
+
+
+def _collect_all(options, subject=None):
+    # Collect stats for all instances concurrently on a bounded pool of threads
+    # (collections mostly wait on varnishstat & varnishadm). Results are
+    # returned in the same order instances were provided, and a failed
+    # collection results in an empty set of stats for that instance. When a
+    # subject type is given, only stats relevant for it are guaranteed.
+    def collect(instance, deadline=None):
+        _DEADLINES.value = deadline
+        try:
+            stats = _collect(instance, options, subject)
+        except Exception as e:
+            return failed(instance, e)
+        finally:
+            _DEADLINES.value = None
+        if deadline is not None and time.time() > deadline:
+            return failed(instance, 'timed out after {} seconds'.format(options.timeout))
+        return stats
+
+    def failed(instance, error):
+        sys.stderr.write('Failed to collect stats for instance "{}": {}\n'.format(
+            instance, error))
+        return Stats(ITEMS, SUBJECTS, options.exclusions)
+
+    # Every instance gets --timeout seconds since the beginning: child
+    # processes still running by then are killed, and results not available
+    # by then are reported as failed without waiting for them.
+    instances = _instances(options)
+    deadline = time.time() + options.timeout if options.timeout > 0 else None
+    if len(instances) == 1 or options.workers <= 1:
+        result = [(instance, collect(instance, deadline)) for instance in instances]
+    else:
+        from concurrent.futures import ThreadPoolExecutor, wait
+        executor = ThreadPoolExecutor(max_workers=min(options.workers, len(instances)))
+        try:
+            futures = [executor.submit(collect, instance, deadline) for instance in instances]
+            wait(futures, timeout=options.timeout if deadline is not None else None)
+            result = [
+                (instance, future.result() if future.done() else failed(
+                    instance, 'timed out after {} seconds'.format(options.timeout)))
+                for instance, future in zip(instances, futures)]
+        finally:
+            executor.shutdown(wait=False)
+
+    # Aggregate dynamic backends & limit the number of subjects, if requested.
+    if options.rollup_backends:
+        result = [(instance, _rollup(options, stats)) for instance, stats in result]
+    if options.top:
+        result = [(instance, _top(options, instance, stats)) for instance, stats in result]
+
+    # Include the synthetic aggregate of all instances, if requested.
+    if options.aggregate:
+        result.append((AGGREGATE_INSTANCE, _aggregate(options, result)))
+
+    return result
+
+
+def _aggregate(options, results):
+    # Return stats of a synthetic instance summing counters & gauges of the
+    # given (instance, stats) pairs, except the ones in AGGREGATE_MAXIMUMS &
+    # AGGREGATE_DISCARDED. Any other item (e.g. bitmaps) is discarded, as when
+    # aggregating items of a single instance.
+    result = Stats(ITEMS, SUBJECTS, options.exclusions)
+    if results:
+        result.timestamp = max(stats.timestamp for _, stats in results)
+    maximums = {}
+    for instance, stats in results:
+        for item in stats.items:
+            if item.type not in (TYPE_COUNTER, TYPE_GAUGE) or \
+               AGGREGATE_DISCARDED.match(item.name) is not None:
+                continue
+            if AGGREGATE_MAXIMUMS.match(item.name) is not None:
+                current = maximums.get(item.name)
+                if current is None or item.value > current.value:
+                    maximums[item.name] = item
+            else:
+                result.add(item)
+    for item in maximums.values():
+        result.add(item)
+    return result
+
+
+# Deadline (if any) of the collection running in the current thread, enforced
+# on child processes by _supervise().
+_DEADLINES = threading.local()
+
+# CPU time of child processes reaped by _wait() in the current thread, so
+# concurrent collections don't account each other's children.
+_CHILDREN_CPU = threading.local()
+
+_SNAPSHOTS = {}
+_SNAPSHOTS_LOCK = threading.Lock()
+_SNAPSHOTS_FLIGHTS = {}
+
+
+def _collect(instance, options, subject=None):
+    # Return a recent enough snapshot previously collected by this process for
+    # the given instance & exclusions, or collect a new one (possibly reusing
+    # the shared on-disk snapshot). Concurrent threads asking for the same
+    # snapshot wait for the in-flight collection. Snapshots always include
+    # all stats, so collections are restricted to a subject type only when
+    # they are not shared.
+    if options.max_age > 0:
+        key = (instance, options.exclusions.pattern)
+        with _SNAPSHOTS_LOCK:
+            flight = _SNAPSHOTS_FLIGHTS.setdefault(key, threading.Lock())
+        with flight:
+            with _SNAPSHOTS_LOCK:
+                snapshot = _SNAPSHOTS.get(key)
+            if snapshot is not None and time.time() - snapshot[0] < options.max_age:
+                return snapshot[1]
+
+            stats = _snapshot(instance, options)
+            _store(instance, options, stats)
+            return stats
+
+    return _stats(instance, options, subject)
+
+
+def _store(instance, options, stats):
+    with _SNAPSHOTS_LOCK:
+        _SNAPSHOTS[(instance, options.exclusions.pattern)] = (stats.timestamp, stats)
+
+
+def _snapshot(instance, options):
+    # Return stats from the on-disk snapshot of the given instance & exclusions
+    # if it is fresh enough. Otherwise collect them while holding an exclusive
+    # lock, so concurrent executions wait for the in-flight collection instead
+    # of starting their own, and persist the result for the next ones.
+    import fcntl
+
+    path = _state_path(options, instance, 'snapshot', options.exclusions.pattern)
+    with _open_state(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with _open_state(path, 'r') as fd:
+                snapshot = json.load(fd)
+            if time.time() - snapshot['timestamp'] < options.max_age:
+                stats = Stats(ITEMS, SUBJECTS, options.exclusions)
+                stats.load(snapshot['items'])
+                stats.timestamp = snapshot['timestamp']
+                return stats
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+        stats = _stats(instance, options)
+        _write_json(path, {
+            'timestamp': stats.timestamp,
+            'items': stats.dump(),
+        })
+        return stats
+
+
+def _emitted(options, instance, stats):
+    # Return the items of 'stats' to be emitted. When --changed-only is
+    # enabled, that's only items whose value changed since the last execution
+    # or that haven't been emitted for --heartbeat seconds. Last emitted values
+    # are persisted per instance in the state directory and protected by a
+    # lock.
+    items = stats.items
+    if options.rates:
+        items = list(items) + _rates(options, instance, stats)
+    if not options.changed_only:
+        return items
+
+    import fcntl
+
+    path = _state_path(options, instance, 'emitted', options.exclusions.pattern)
+    with _open_state(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with _open_state(path, 'r') as fd:
+                state = json.load(fd)
+        except (IOError, ValueError):
+            state = {}
+
+        now = time.time()
+        result, updated = [], {}
+        for item in items:
+            previous = state.get(item.name)
+            if not isinstance(previous, list) or \
+               previous[0] != item.value or \
+               now - previous[1] >= options.heartbeat:
+                result.append(item)
+                updated[item.name] = [item.value, now]
+            else:
+                updated[item.name] = previous
+        _write_json(path, updated)
+
+    return result
+
+
+def _rates(options, instance, stats):
+    # Return '<name>.rate' gauges with the per second rate of all counters,
+    # computed against the values of the previous execution, which are
+    # persisted per instance in the state directory. Counters that were reset
+    # are skipped instead of reporting negative or bogus rates:
+    #   - All counters after a restart of the child process, i.e. 'MAIN.uptime'
+    #     going backwards or growing clearly less than the wall clock, or any
+    #     counter not bound to a subject going backwards.
+    #   - All counters of a subject after any of them went backwards (e.g. a
+    #     backend being re-created).
+    import fcntl
+
+    path = _state_path(options, instance, 'rates', options.exclusions.pattern)
+    with _open_state(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with _open_state(path, 'r') as fd:
+                state = json.load(fd)
+            previous, rates = state['values'], state['rates']
+            elapsed = stats.timestamp - state['timestamp']
+            uptime = stats.get('MAIN.uptime')
+            restarted = \
+                uptime is not None and \
+                state['uptime'] is not None and (
+                    uptime < state['uptime'] or
+                    uptime - state['uptime'] < elapsed - RATES_UPTIME_SLACK)
+        except (IOError, ValueError, KeyError, TypeError):
+            previous, rates, elapsed, restarted = {}, {}, None, False
+
+        # The same collection (e.g. a shared snapshot) results in the same
+        # rates.
+        if elapsed != 0:
+            values, rates, resets = {}, {}, set()
+            for item in stats.items:
+                if item.type == TYPE_COUNTER:
+                    values[item.name] = item.value
+                    if previous.get(item.name) is not None and \
+                       item.value < previous[item.name]:
+                        resets.add((item.subject_type, item.subject_value))
+            if ('items', None) in resets:
+                restarted = True
+            if elapsed is not None and elapsed > 0 and not restarted:
+                for item in stats.items:
+                    if item.type == TYPE_COUNTER and \
+                       previous.get(item.name) is not None and \
+                       (item.subject_type, item.subject_value) not in resets:
+                        rates[item.name] = round(
+                            (item.value - previous[item.name]) / elapsed, 6)
+            _write_json(path, {
+                'timestamp': stats.timestamp,
+                'uptime': stats.get('MAIN.uptime'),
+                'values': values,
+                'rates': rates,
+            })
+
+    result = []
+    for item in stats.items:
+        if item.name in rates:
+            result.append(Item(
+                name=item.name + '.rate',
+                value=rates[item.name],
+                type=TYPE_GAUGE,
+                subject_type=item.subject_type,
+                subject_value=item.subject_value))
+    return result
+
+
+def _top(options, instance, stats):
+    # Return stats keeping only the --top most active subjects of the given
+    # subject types, and folding items of all other subjects into a synthetic
+    # '__other__' subject. Activity is the increase of a counter (see
+    # TOP_SUBJECTS) since the previous execution, persisted per instance in the
+    # state directory together with:
+    #   - The kept subjects. Membership is sticky: a kept subject is only
+    #     dropped after ranking out of the top for TOP_EVICTIONS consecutive
+    #     executions (or when it disappears), and new subjects only take free
+    #     slots.
+    #   - Counters of every subject & accumulated counters of '__other__'
+    #     subjects, which only grow by the increase of their current members
+    #     (so they stay monotonic when subjects join or leave). Gauges are
+    #     summed as usual and anything else is discarded.
+    # Subject types missing in the collection (e.g. a 'discover <subject>'
+    # execution) keep their previous state.
+    import fcntl
+
+    limits = dict(options.top)
+
+    # Current value of the activity counter & all counters of every subject.
+    values = dict((subject_type, {}) for subject_type in limits)
+    counters = dict((subject_type, {}) for subject_type in limits)
+    for item in stats.items:
+        if item.subject_type in limits and item.type == TYPE_COUNTER:
+            field = TOP_SUBJECTS.get(item.subject_type, (None, False))[0]
+            if field is None or item.name.endswith('.' + field):
+                activity = values[item.subject_type]
+                activity[item.subject_value] = \
+                    activity.get(item.subject_value, 0) + item.value
+            start, end = re.match(SUBJECTS[item.subject_type], item.name).span(1)
+            counters[item.subject_type].setdefault(item.subject_value, {})[
+                item.name[:start] + '\0' + item.name[end:]] = item.value
+
+    def other(subject_type, subject_value):
+        if TOP_SUBJECTS.get(subject_type, (None, False))[1]:
+            return subject_value.split('.', 1)[0] + '.' + TOP_OTHER
+        return TOP_OTHER
+
+    path = _state_path(options, instance, 'top', options.exclusions.pattern)
+    with _open_state(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with _open_state(path, 'r') as fd:
+                state = json.load(fd)
+            elapsed = stats.timestamp - state['timestamp']
+            previous, kept, misses, others = \
+                state['values'], state['kept'], state['misses'], state['others']
+            previous_counters = state['counters']
+        except (IOError, ValueError, KeyError, TypeError):
+            previous, kept, misses, others, previous_counters, elapsed = \
+                {}, {}, {}, {}, {}, None
+
+        # The same collection (e.g. a shared snapshot) results in the same
+        # state. New subjects and counters that went backwards are ranked
+        # (and accumulated) by their current value.
+        if elapsed != 0 or any(subject_type not in kept for subject_type in limits):
+            for subject_type, limit in limits.items():
+                subjects = stats.subjects(subject_type)
+                if not subjects and subject_type in kept:
+                    values[subject_type] = previous.get(subject_type, {})
+                    counters[subject_type] = previous_counters.get(subject_type, {})
+                    continue
+
+                # Rank subjects by activity.
+                activity = {}
+                for subject in subjects:
+                    current = values[subject_type].get(subject, 0)
+                    before = previous.get(subject_type, {}).get(subject)
+                    if before is not None and current >= before:
+                        activity[subject] = current - before
+                    else:
+                        activity[subject] = current
+                top = set(sorted(
+                    activity, key=lambda subject: (-activity[subject], subject))[:limit])
+
+                # Update membership: kept subjects ranking out of the top are
+                # dropped after TOP_EVICTIONS executions, and free slots are
+                # taken by the most active new subjects. Executions without
+                # any activity (e.g. a discovery right after a collection)
+                # don't rank anything.
+                idle = subject_type in kept and not any(activity.values())
+                missed = dict(
+                    (subject, 0 if subject in top else
+                        misses.get(subject_type, {}).get(subject, 0) + (not idle))
+                    for subject in kept.get(subject_type, []) if subject in subjects)
+                members = [
+                    subject for subject in kept.get(subject_type, [])
+                    if subject in missed and missed[subject] < TOP_EVICTIONS]
+                for subject in sorted(
+                        top - set(members),
+                        key=lambda subject: (-activity[subject], subject)):
+                    if len(members) >= limit:
+                        break
+                    members.append(subject)
+                    missed[subject] = 0
+                kept[subject_type] = members
+                misses[subject_type] = dict(
+                    (subject, missed[subject]) for subject in members)
+
+                # Accumulate increases of counters of folded subjects.
+                accumulated = others.setdefault(subject_type, {})
+                members = set(members)
+                for subject in subjects - members:
+                    target = accumulated.setdefault(other(subject_type, subject), {})
+                    before = previous_counters.get(subject_type, {}).get(subject, {})
+                    for key, current in counters[subject_type].get(subject, {}).items():
+                        increase = current - before[key] \
+                            if key in before and current >= before[key] else current
+                        target[key] = target.get(key, 0) + increase
+            _write_json(path, {
+                'timestamp': stats.timestamp,
+                'values': values,
+                'counters': counters,
+                'kept': kept,
+                'misses': misses,
+                'others': others,
+            })
+
+    # Fold items of dropped subjects, unless nothing has to be dropped.
+    # Counters of '__other__' subjects are replaced by the accumulated ones.
+    kept = dict(
+        (subject_type, set(kept[subject_type]))
+        for subject_type in limits
+        if len(stats.subjects(subject_type)) > len(kept[subject_type]))
+    if not kept:
+        return stats
+
+    def fold(subject_type, subject_value):
+        subjects = kept.get(subject_type)
+        if subjects is None or subject_value in subjects:
+            return None
+        return other(subject_type, subject_value)
+
+    result = _fold(options, stats, fold, counters=False)
+    folded = set(
+        (subject_type, fold(subject_type, subject))
+        for subject_type in kept
+        for subject in stats.subjects(subject_type) - kept[subject_type])
+    for subject_type, subject in sorted(folded):
+        for key, value in sorted(others.get(subject_type, {}).get(subject, {}).items()):
+            prefix, _, suffix = key.partition('\0')
+            result.add(Item(
+                name=prefix + subject + suffix,
+                value=value,
+                type=TYPE_COUNTER,
+                subject_type=subject_type,
+                subject_value=subject))
+    return result
+
+
+def _rollup(options, stats):
+    # Return stats where dynamic backends (see BACKEND_ROLLUPS) are aggregated
+    # by director / host as usual (i.e. counters & gauges such as 'conn' or
+    # 'healthy' are summed, anything else is discarded), plus a
+    # 'VBE.<rollup>.endpoints' gauge with the number of backends folded into
+    # every rollup.
+    folded = {}
+    for subject in stats.subjects('backends'):
+        for pattern, replacement in BACKEND_ROLLUPS:
+            value, count = pattern.subn(replacement, subject)
+            if count > 0:
+                folded[subject] = value
+                break
+    if not folded:
+        return stats
+
+    result = _fold(
+        options, stats,
+        lambda subject_type, subject_value:
+            folded.get(subject_value) if subject_type == 'backends' else None)
+    endpoints = {}
+    for value in folded.values():
+        endpoints[value] = endpoints.get(value, 0) + 1
+    for value, count in endpoints.items():
+        result.add(Item(
+            name='VBE.{}.endpoints'.format(value),
+            value=count,
+            type=TYPE_GAUGE,
+            subject_type='backends',
+            subject_value=value))
+    return result
+
+
+def _fold(options, stats, fold, counters=True):
+    # Return a copy of stats where items whose subject is renamed by
+    # fold(<subject type>, <subject value>) (i.e. it doesn't return None) are
+    # renamed accordingly and aggregated as usual: counters & gauges are
+    # summed, anything else is discarded. Counters of renamed subjects can
+    # also be discarded, for the caller to provide its own.
+    result = Stats(ITEMS, SUBJECTS, options.exclusions)
+    result.timestamp = stats.timestamp
+    for item in stats.items:
+        value = fold(item.subject_type, item.subject_value)
+        if value is not None:
+            if not counters and item.type == TYPE_COUNTER:
+                continue
+            start, end = re.match(SUBJECTS[item.subject_type], item.name).span(1)
+            item = Item(
+                name=item.name[:start] + value + item.name[end:],
+                value=item.value,
+                type=item.type,
+                subject_type=item.subject_type,
+                subject_value=value)
+        result.add(item)
+    return result
+
+
+def _state_path(options, instance, kind, *extra):
+    # Build the path of a state file (e.g. snapshot) in the state directory for
+    # a given instance. Any extra value the state depends on (e.g. exclusions)
+    # is hashed into the file name. The state directory is created if needed,
+    # and refused unless it's a directory owned by the effective user and not
+    # writable by anyone else: state is trusted and the script usually runs as
+    # root.
+    import hashlib
+
+    try:
+        os.makedirs(options.state_dir, 0o750)
+    except OSError:
+        pass
+    info = os.lstat(options.state_dir)
+    if not stat.S_ISDIR(info.st_mode) or \
+       info.st_uid != os.geteuid() or \
+       info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise IOError(
+            'Unsafe state directory "{}": it must be a directory owned by UID {}'
+            ' and not writable by group or others'.format(options.state_dir, os.geteuid()))
+    return os.path.join(options.state_dir, '{}-{}-{}.json'.format(
+        kind,
+        re.sub(r'[^\w\.\-]', '_', instance) or '_',
+        hashlib.sha1('\0'.join((instance,) + extra).encode('utf-8')).hexdigest()[:8]))
+
+
+def _open_state(path, mode):
+    # Open a state file for reading ('r') or locking ('a', created if needed)
+    # without following symlinks.
+    if mode == 'r':
+        flags = os.O_RDONLY
+    else:
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+    return os.fdopen(os.open(path, flags | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600), mode)
+
+
+def _write_json(path, data):
+    # Atomically replace 'path' with the JSON serialization of 'data', written
+    # to a new temporary file in the same directory.
+    import tempfile
+
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as stream:
+            json.dump(data, stream, separators=(',', ':'))
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+class Classifier(object):
+    '''
+    A class to classify raw stat names: checks them against the items
+    definitions, rewrites them and assigns their subject (type & value).
+    Patterns are indexed by the leading segment of the names they can match
+    (e.g. 'MAIN', 'VBE'), so only relevant ones are tried (and compiled), and
+    results are memoized per name, given the set of names is almost the same on
+    every collection. Results are not persisted between executions: loading
+    them costs more than classifying names again.
+    '''
+
+    def __init__(self, items_definitions, rewrites, subjects_patterns, exclusions):
+        # Index items definitions by prefix. Definitions without a literal
+        # prefix are tried for all names.
+        self._items_definitions = {}
+        self._items_wildcards = []
+        for definition in items_definitions:
+            prefixes = _prefixes(definition)
+            if prefixes is None:
+                self._items_wildcards.append(definition)
+            else:
+                for prefix in prefixes:
+                    self._items_definitions.setdefault(prefix, []).append(definition)
+        self._items_patterns = {}
+
+        # Rewrites & subjects keep their order, but are only tried (and
+        # compiled) when the current prefix of the name is a possible match.
+        self._rewrites = [
+            (_prefixes(pattern), pattern, repl)
+            for pattern, repl in rewrites]
+        self._subjects_patterns = [
+            (_prefixes(pattern), subject, pattern)
+            for subject, pattern in subjects_patterns.items()
+            if pattern is not None]
+        self._compiled = {}
+
+        # Other initializations.
+        self._exclusions = exclusions
+        self._memo = {}
+        self._excluded = {}
+
+    def classify(self, name):
+        # Return a (name, subject_type, subject_value) tuple with the rewritten
+        # name & subject of a raw name, or None if it doesn't match the items
+        # definitions.
+        try:
+            return self._memo[name]
+        except KeyError:
+            pass
+
+        result = None
+        if self._items_pattern(name.split('.', 1)[0]).match(name) is not None:
+            # Rewrite name.
+            result = name
+            for prefixes, pattern, repl in self._rewrites:
+                if prefixes is None or result.split('.', 1)[0] in prefixes:
+                    pattern = self._compile(pattern)
+                    if pattern.match(result):
+                        result = pattern.sub(repl, result)
+
+            # Find subject.
+            prefix = result.split('.', 1)[0]
+            for prefixes, subject, pattern in self._subjects_patterns:
+                if prefixes is None or prefix in prefixes:
+                    match = self._compile(pattern).match(result)
+                    if match is not None:
+                        result = (result, subject, sys.intern(match.group(1)))
+                        break
+            else:
+                result = (result, None, None)
+
+        # Keep the memo bounded (e.g. churn of dynamic backends in a long
+        # running collector).
+        if len(self._memo) >= CLASSIFIER_MEMO_SIZE:
+            self._memo.clear()
+        self._memo[name] = result
+        return result
+
+    def excluded(self, name):
+        # Check if a (rewritten) name matches the exclusions.
+        try:
+            return self._excluded[name]
+        except KeyError:
+            if len(self._excluded) >= CLASSIFIER_MEMO_SIZE:
+                self._excluded.clear()
+            result = self._excluded[name] = self._exclusions.match(name) is not None
+            return result
+
+    def _compile(self, pattern):
+        # Return a compiled rewrite / subject pattern.
+        try:
+            return self._compiled[pattern]
+        except KeyError:
+            result = self._compiled[pattern] = re.compile(pattern)
+            return result
+
+    def _items_pattern(self, prefix):
+        # Return the compiled expression matching all items definitions that
+        # are relevant for a given prefix.
+        try:
+            return self._items_patterns[prefix]
+        except KeyError:
+            definitions = self._items_definitions.get(prefix, []) + self._items_wildcards
+            result = self._items_patterns[prefix] = re.compile(
+                r'^(?:' + '|'.join(definitions or [r'(?!)']) + r')$')
+            return result
+
+
+_CLASSIFIERS = {}
+_CLASSIFIERS_LOCK = threading.Lock()
+
+
+def _classifier(items_definitions, subjects_patterns, exclusions):
+    # Return the (process wide) classifier for the given items definitions,
+    # subject patterns & exclusions.
+    key = (tuple(items_definitions), tuple(subjects_patterns.items()), exclusions.pattern)
+    with _CLASSIFIERS_LOCK:
+        if key not in _CLASSIFIERS:
+            _CLASSIFIERS[key] = Classifier(
+                items_definitions, REWRITES, subjects_patterns, exclusions)
+        return _CLASSIFIERS[key]
+
+
+def _prefixes(pattern):
+    # Return the set of literal leading segments (e.g. 'MAIN' for 'MAIN\.foo'
+    # or 'MSE', 'SMA' & 'SMF' for '^((?:MSE|SMA|SMF)\..+)$') names matching a
+    # pattern must start with, or None if that can't be determined.
+    depth = 0
+    escaped = False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char in '([':
+            depth += 1
+        elif char in ')]':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return None
+    match = re.match(r'^\^?\(?(?:\(\?:)?([\w|]+)\)?\\\.', pattern)
+    if match is None:
+        return None
+    return frozenset(match.group(1).split('|'))
+
+
+def _globs(pattern):
+    # Return a list of globs (as understood by 'varnishstat -f') matching at
+    # least all names fully matched by a pattern, or None if that can't be
+    # expressed. Only literals, '.', character classes, '*' & '+' quantifiers,
+    # groups & alternations are supported. Lookaheads are ignored, which only
+    # makes the result broader.
+    literals = re.compile(r'(?:(?:\\[^\w\s]|[^\\.\[\](){}|*+?^$])(?![*+?{]))+')
+
+    def parse(i):
+        alternatives, current = [], ['']
+        while i < len(pattern) and pattern[i] != ')':
+            char = pattern[i]
+            match = literals.match(pattern, i)
+            if match is not None:
+                pieces, i = [_glob_escape(_unescape(match.group(0)))], match.end()
+            elif char == '|':
+                alternatives.extend(current)
+                current, i = [''], i + 1
+                continue
+            elif char in '^$':
+                if i not in (0, len(pattern) - 1):
+                    raise ValueError(pattern)
+                i += 1
+                continue
+            elif pattern.startswith('(?!', i) or pattern.startswith('(?=', i):
+                i = parse(i + 3)[1] + 1
+                continue
+            elif char == '\\':
+                if i + 1 == len(pattern) or pattern[i + 1].isalnum():
+                    raise ValueError(pattern)
+                pieces, i = [_glob_escape(pattern[i + 1])], i + 2
+            elif char == '.':
+                pieces, i = ['?'], i + 1
+            elif char == '[':
+                match = re.compile(r'\[\^?\]?(?:\\.|[^\]])*\]').match(pattern, i)
+                if match is None:
+                    raise ValueError(pattern)
+                pieces, i = ['?'], match.end()
+            elif char == '(':
+                if pattern.startswith('(?:', i):
+                    pieces, i = parse(i + 3)
+                elif pattern.startswith('(?', i):
+                    raise ValueError(pattern)
+                else:
+                    pieces, i = parse(i + 1)
+                if i == len(pattern):
+                    raise ValueError(pattern)
+                i += 1
+            elif char in '*+?{':
+                raise ValueError(pattern)
+            else:
+                pieces, i = [_glob_escape(char)], i + 1
+
+            # Any repetition becomes a '*' wildcard.
+            if i < len(pattern) and pattern[i] in '*+':
+                pieces, i = ['*'], i + 1
+                if i < len(pattern) and pattern[i] == '?':
+                    i += 1
+            elif i < len(pattern) and pattern[i] in '?{':
+                raise ValueError(pattern)
+
+            if len(pieces) == 1:
+                current = [prefix + pieces[0] for prefix in current]
+            else:
+                current = [prefix + piece for prefix in current for piece in pieces]
+            if len(alternatives) + len(current) > 1000:
+                raise ValueError(pattern)
+        return alternatives + current, i
+
+    try:
+        result, i = parse(0)
+    except ValueError:
+        return None
+    return result if i == len(pattern) else None
+
+
+def _glob_escape(value):
+    for char in '\\*?[':
+        value = value.replace(char, '\\' + char)
+    return value
+
+
+def _glob_head(glob):
+    # Return the literal (unescaped) leading part of a glob.
+    return _unescape(re.match(r'^(?:\\.|[^*?\[\\])*', glob).group(0))
+
+
+def _unescape(value):
+    return re.sub(r'\\(.)', r'\1', value) if '\\' in value else value
 
 
 class Stats(object):
@@ -476,54 +1609,96 @@ class Stats(object):
     A class to hold results for a call to _stats: keeps all processed items and
     all subjects seen per subject type and provides helper methods to build and
     process those items.
+
+    Items are not kept as Item instances (there may be tens of thousands of
+    them), but as parallel arrays indexed by the position of the item name:
+    values, types (one byte each) and (shared) subject type & value pairs.
     '''
 
     def __init__(self, items_definitions, subjects_patterns, exclusions, log_handler=None):
-        # Build items regular expression that will be used to match item names
-        # and discover item types.
-        self._items_pattern = re.compile(
-            r'^(?:' + '|'.join(items_definitions) + r')$')
-
-        # Set subject patterns that will be used to assign subject type and
-        # subject values to items.
-        self._subjects_patterns = subjects_patterns
+        # Get the classifier that will be used to match item names, rewrite
+        # them and assign subject type and subject values to items.
+        self._classifier = _classifier(items_definitions, subjects_patterns, exclusions)
 
         # Other initializations.
-        self._exclusions = exclusions
         self._log_handler = log_handler or sys.stderr.write
-        self._items = {}
+        self._positions = {}
+        self._values = []
+        self._types = bytearray()
+        self._pairs = []
+        self._shared_pairs = {}
         self._subjects = {}
+        self.timestamp = time.time()
 
     @property
     def items(self):
         # Return all items that haven't had their value discarded because an
         # invalid aggregation.
-        return (item for item in self._items.values() if item.value is not None)
+        return (
+            Item(name, self._values[i], self._types[i], *self._pairs[i])
+            for name, i in self._positions.items()
+            if self._values[i] is not None)
 
     def add(self, item):
         # Filter excluded items.
-        if self._exclusions.match(item.name) is not None:
-            return
+        if self._classifier.excluded(item.name):
+            return False
 
         # Add a new item to the internal state or simply aggregate it's value
-        # if an item with the same name has already been added.
-        if item.name in self._items:
-            self._items[item.name].aggregate(item.value)
+        # if an item with the same name has already been added. Only counter
+        # and gauges can be aggregated. In any other case, mark the item's
+        # value as discarded.
+        i = self._positions.get(item.name)
+        if i is None:
+            self._register(item)
+        elif self._types[i] in (TYPE_COUNTER, TYPE_GAUGE):
+            self._values[i] += item.value
         else:
-            # Add new item to the internal state.
-            self._items[item.name] = item
-
-            # Also, register this item's subject in the corresponding set.
-            if item.subject_type != None and item.subject_value != None:
-                if item.subject_type not in self._subjects:
-                    self._subjects[item.subject_type] = set()
-                self._subjects[item.subject_type].add(item.subject_value)
+            self._values[i] = None
+        return True
+
+    def _register(self, item):
+        # Add new item to the internal state.
+        pair = (item.subject_type, item.subject_value)
+        self._positions[item.name] = len(self._values)
+        self._values.append(item.value)
+        self._types.append(item.type)
+        self._pairs.append(self._shared_pairs.setdefault(pair, pair))
+
+        # Also, register this item's subject in the corresponding set.
+        if item.subject_type != None and item.subject_value != None:
+            if item.subject_type not in self._subjects:
+                self._subjects[item.subject_type] = set()
+            self._subjects[item.subject_type].add(item.subject_value)
+
+    def dump(self):
+        # Return a JSON serializable representation of all items, suitable to
+        # be restored using load().
+        return [
+            [name, self._values[i], self._types[i]] + list(self._pairs[i])
+            for name, i in self._positions.items()]
+
+    def load(self, rows):
+        # Restore items from the output of dump(). Exclusions were already
+        # applied when those items were added, so they are not checked again.
+        for name, value, type, subject_type, subject_value in rows:
+            self._register(Item(
+                name=name,
+                value=value,
+                type=type,
+                subject_type=subject_type,
+                subject_value=subject_value))
+
+    def accepts(self, name):
+        # Check if a (raw) name matches the items definitions.
+        return self._classifier.classify(name) is not None
 
     def get(self, name, default=None):
         # Return current value for a particular item or the given default value
         # if that item is not available or has had it's value discarded.
-        if name in self._items and self._items[name].value is not None:
-            return self._items[name].value
+        i = self._positions.get(name)
+        if i is not None and self._values[i] is not None:
+            return self._values[i]
         else:
             return default
 
@@ -538,21 +1713,16 @@ class Stats(object):
             self, name, value, type, subject_type=None,
             subject_value=None):
         # Filter invalid items.
-        if self._items_pattern.match(name) is None:
+        classification = self._classifier.classify(name)
+        if classification is None:
             return None
 
         # Rewrite name.
-        name = _rewrite(name)
+        name = classification[0]
 
         # Initialize subject_type and subject_value if none were provided.
         if subject_type is None and subject_value is None:
-            for subject, subject_re in self._subjects_patterns.items():
-                if subject_re is not None:
-                    match = subject_re.match(name)
-                    if match is not None:
-                        subject_type = subject
-                        subject_value = match.group(1)
-                        break
+            subject_type, subject_value = classification[1:]
 
         # Return item instance.
         return Item(
@@ -564,95 +1734,537 @@ class Stats(object):
         )
 
 
-def _stats(instance, exclusions):
+def _stats(instance, options, subject=None):
     # Initializations.
-    stats = Stats(ITEMS, SUBJECTS, exclusions)
+    stats = Stats(ITEMS, SUBJECTS, options.exclusions)
     vbe_happy_pattern = re.compile(r'^VBE\..+\.happy$')
+    costs = {
+        'started': time.perf_counter(),
+        'children': getattr(_CHILDREN_CPU, 'value', 0.0),
+        'backends': 0.0,
+        'counters': 0.0,
+        'classification': 0.0,
+        'pid': 0.0,
+        'proc': 0.0,
+        'seen': 0,
+        'kept': 0,
+        'excluded': 0,
+    }
+    cli = _cli(instance) if options.cli == 'native' else None
 
-    # Fetch backends through varnishadm.
-    backends = _backend_stats(stats, instance)
-
-    # Fetch stats through varnishstat & filter / normalize output.
-    rc, output = _execute('varnishstat -1 -j -n "{}"'.format(instance))
-    if rc == 0:
-        for name, data in json.loads(output).items():
-            # Filter invalid items.
-            if 'value' not in data:
-                continue
-
-            # Get item type.
-            if data['flag'] == 'c':
-                type = TYPE_COUNTER
-            elif data['flag'] == 'g':
-                type = TYPE_GAUGE
-            else:
-                type = TYPE_OTHER
-
-            # 'VBE.*.happy' items are bitmaps storing results (i.e. success or
-            # failure) of the last 64 backend probes. From the 'varnishstat'
-            # point of view, those items are represented as 64 bit integers.
-            # Submitting such big integer values to Zabbix is problematic:
-            #   - Although Python (when parsing 'varnishstat' output & when
-            #     dumping script output) and Zabbix (when extracting values from
-            #     a JSON master item) are able to serialize / deserialize 64 bit
-            #     ints in JSON values just fine, integer precission in a valid
-            #     JSON value should be limited to 53 bits. Reason is that
-            #     numeric values in JavaScript are internally coded as float64,
-            #     which effectively limits precision of ints to 53 bits. A
-            #     JavaScript post-processing of JSON values in Zabbix would hit
-            #     the 53 bits limit because of the Duktape engine.
-            #   - Although JavaScript post-processing is just a particular use
-            #     case, in monitoring ecosystems it's general practice to assume
-            #     ints are limited to 53 bits. For example, same limitation
-            #     applies in the Prometheus exposition format where all metrics
-            #     are float64. Approximations are possible, but that's far from
-            #     ideal, and definitely is a no-go for bitmaps. From the
-            #     Prometheus docs, to put the 53 bits limitation in perspective:
-            #     'a counter, even if incremented one million times per second,
-            #     will only run into precision issues after over 285 years'.
-            #
-            # Although the described limitation applies to all 'varnishstat'
-            # values (all of them are int64) during a JavaScript post-processing
-            # step in the Zabbix side, it only represents a realistic issue for
-            # 'VBE.*.happy' items, and that's why here values of those items are
-            # truncated to keep just the less significative 50 bits.
-            value = data['value']
-            if vbe_happy_pattern.match(name) is not None:
-                value = value & (2**50 - 1)
-
-            # Build item.
-            item = stats.build_item(name, value, type)
-            if item is None:
-                continue
-
-            # Filter out items from unknown backends (i.e. backends from other
-            # warm or cold VCLs). This is only possible if the list of backends
-            # was successfully fetched through varnishadm.
-            if item.subject_type == 'backends' and \
-               backends is not None and \
-               item.subject_value not in backends:
-                continue
+    try:
+        # Fetch backends through varnishadm.
+        checkpoint = time.perf_counter()
+        backends, cache = _backend_stats(stats, instance, cli, options)
+        reused = cache is not None and cache['backends'] is not None
+        healthy = 0
+        costs['backends'] = time.perf_counter() - checkpoint
+
+        # Fetch stats directly from the VSM or through varnishstat & filter /
+        # normalize output. When collecting self stats, time spent fetching &
+        # parsing counters is told apart from time spent processing them.
+        checkpoint = time.perf_counter()
+        counters = None
+        if options.source == 'vsm':
+            counters = _vsm_counters(stats, instance)
+        if counters is None:
+            counters = _varnishstat_counters(
+                stats, instance,
+                _varnishstat_filters(options.exclusions, subject)
+                if options.filter == 'varnishstat' else [])
+        costs['counters'] = time.perf_counter() - checkpoint
+        if counters is not None:
+            checkpoint, fetching = time.perf_counter(), costs['counters']
+            if options.self_stats:
+                counters = _timed(counters, costs, 'counters')
+            for name, flag, value in counters:
+                costs['seen'] += 1
+
+                # When the list of backends has been reused from the cache, get
+                # backend health from 'VBE.<active VCL>.*.is_healthy' counters
+                # instead of 'backend.list'.
+                if name.endswith('.is_healthy') and name.startswith('VBE.'):
+                    healthy += 1
+                    if reused and name.startswith('VBE.' + cache['active'] + '.'):
+                        name = name[:-len('is_healthy')] + 'healthy'
+                        flag = 'g'
+
+                # Get item type.
+                if flag == 'c':
+                    type = TYPE_COUNTER
+                elif flag == 'g':
+                    type = TYPE_GAUGE
+                else:
+                    type = TYPE_OTHER
+
+                # 'VBE.*.happy' items are bitmaps storing results (i.e. success
+                # or failure) of the last 64 backend probes. From the
+                # 'varnishstat' point of view, those items are represented as
+                # 64 bit integers. Submitting such big integer values to Zabbix
+                # is problematic:
+                #   - Although Python (when parsing 'varnishstat' output & when
+                #     dumping script output) and Zabbix (when extracting values
+                #     from a JSON master item) are able to serialize /
+                #     deserialize 64 bit ints in JSON values just fine, integer
+                #     precission in a valid JSON value should be limited to 53
+                #     bits. Reason is that numeric values in JavaScript are
+                #     internally coded as float64, which effectively limits
+                #     precision of ints to 53 bits. A JavaScript post-processing
+                #     of JSON values in Zabbix would hit the 53 bits limit
+                #     because of the Duktape engine.
+                #   - Although JavaScript post-processing is just a particular
+                #     use case, in monitoring ecosystems it's general practice
+                #     to assume ints are limited to 53 bits. For example, same
+                #     limitation applies in the Prometheus exposition format
+                #     where all metrics are float64. Approximations are
+                #     possible, but that's far from ideal, and definitely is a
+                #     no-go for bitmaps. From the Prometheus docs, to put the 53
+                #     bits limitation in perspective: 'a counter, even if
+                #     incremented one million times per second, will only run
+                #     into precision issues after over 285 years'.
+                #
+                # Although the described limitation applies to all 'varnishstat'
+                # values (all of them are int64) during a JavaScript
+                # post-processing step in the Zabbix side, it only represents a
+                # realistic issue for 'VBE.*.happy' items, and that's why here
+                # values of those items are truncated to keep just the less
+                # significative 50 bits.
+                if vbe_happy_pattern.match(name) is not None:
+                    value = value & (2**50 - 1)
+
+                # Build item.
+                item = stats.build_item(name, value, type)
+                if item is None:
+                    continue
+
+                # Filter out items from unknown backends (i.e. backends from
+                # other warm or cold VCLs). This is only possible if the list of
+                # backends was successfully fetched through varnishadm.
+                if item.subject_type == 'backends' and \
+                   backends is not None and \
+                   item.subject_value not in backends:
+                    continue
+
+                # Add item to the result.
+                if stats.add(item):
+                    costs['kept'] += 1
+                else:
+                    costs['excluded'] += 1
+            costs['classification'] = \
+                time.perf_counter() - checkpoint - (costs['counters'] - fetching)
+            if cache is not None:
+                _update_backends_cache(stats, cache, backends, reused, healthy)
+
+            # Get worker process PID if possible (it is only available in VCP
+            # 6.x) and use it to include memory and page fault stats.
+            checkpoint = time.perf_counter()
+            pid = _pid(instance, cli)
+            costs['pid'] = time.perf_counter() - checkpoint
+            if pid is not None:
+                checkpoint = time.perf_counter()
+                _memory_stats(stats, pid)
+                proc_stat = _proc_stat(stats, pid)
+                _page_fault_stats(stats, proc_stat)
+                _thread_stats(stats, pid, proc_stat)
+                _io_stats(stats, pid)
+                _cgroup_stats(stats, pid)
+                costs['proc'] = time.perf_counter() - checkpoint
+
+        # Include latency histograms if enabled. Per backend items are built
+        # (i.e. rewritten & classified) and filtered like 'VBE.*' counters.
+        latencies = _latencies(instance, options)
+        if latencies is not None:
+            for name, value, type in latencies.items():
+                if name.startswith('VBE.'):
+                    item = stats.build_item(name, value, type)
+                    if item is None or (
+                            backends is not None and
+                            item.subject_value not in backends):
+                        continue
+                else:
+                    item = Item(name=name, value=value, type=type)
+                stats.add(item)
+    finally:
+        if cli is not None:
+            cli.close()
+
+    # Include collector stats if requested.
+    if options.self_stats:
+        _self_stats(stats, costs)
 
-            # Add item to the result.
-            stats.add(item)
+    # Done!
+    return stats
 
-        # Get worker process PID if possible (it is only available in VCP 6.x)
-        # and use it to include memory and page fault stats.
-        pid = _pid(instance)
-        if pid is not None:
-            _memory_stats(stats, pid)
-            _page_fault_stats(stats, pid)
 
-    # Error recovering information from varnishstat.
+def _timed(iterable, costs, key):
+    # Wrap an iterable accumulating in costs[key] the time spent waiting for
+    # its values.
+    iterator = iter(iterable)
+    while True:
+        checkpoint = time.perf_counter()
+        try:
+            value = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            costs[key] += time.perf_counter() - checkpoint
+        yield value
+
+
+def _self_stats(stats, costs):
+    # Add 'SELF.*' items describing the cost of the collection. CPU time of
+    # child processes (i.e. varnishstat & varnishadm) is the one reported when
+    # they were reaped by this thread (see _wait()).
+    for name, value in (
+            ('duration', time.perf_counter() - costs['started']),
+            ('backends_duration', costs['backends']),
+            ('counters_duration', costs['counters']),
+            ('classification_duration', costs['classification']),
+            ('pid_duration', costs['pid']),
+            ('proc_duration', costs['proc'])):
+        stats.add(Item(
+            name='SELF.' + name,
+            value=round(value, 6),
+            type=TYPE_GAUGE))
+    stats.add(Item(
+        name='SELF.children_cpu',
+        value=round(getattr(_CHILDREN_CPU, 'value', 0.0) - costs['children'], 6),
+        type=TYPE_GAUGE))
+    for name in ('seen', 'kept', 'excluded'):
+        stats.add(Item(
+            name='SELF.counters_' + name,
+            value=costs[name],
+            type=TYPE_GAUGE))
+    stats.add(Item(
+        name='SELF.rss_peak',
+        value=getrusage(RUSAGE_SELF).ru_maxrss * 1024,
+        type=TYPE_GAUGE))
+
+
+_VARNISHSTAT_FILTERS = {}
+
+
+def _varnishstat_filters(exclusions, subject=None):
+    # Return the list of 'varnishstat -f' globs selecting (at least) all
+    # counters needed by _stats(), so varnishstat doesn't serialize (and this
+    # script doesn't parse) counters that would be discarded anyway. An empty
+    # list (i.e. unfiltered output) is returned when some items definition
+    # can't be expressed as globs. Results are memoized.
+    key = (exclusions.pattern, subject)
+    try:
+        return _VARNISHSTAT_FILTERS[key]
+    except KeyError:
+        pass
+
+    globs = []
+    for definition in ITEMS:
+        result = _globs(definition)
+        if result is None:
+            globs = None
+            break
+        globs.extend(result)
+
+    if globs is not None:
+        # Counters used by _backend_stats() & _update_backends_cache() are
+        # always needed. When collecting stats of a single subject type, only
+        # keep other globs whose leading segment may end up, once rewritten,
+        # being of that type.
+        globs.extend(['MAIN.n_backend', 'VBE.*.is_healthy'])
+        heads = dict((glob, _glob_head(glob)) for glob in globs)
+        if subject is not None:
+            prefixes = _subject_prefixes(subject)
+            if prefixes is not None:
+                globs = [
+                    glob for glob in globs
+                    if '.' not in heads[glob] or
+                    heads[glob].split('.', 1)[0] in prefixes or
+                    glob in ('MAIN.n_backend', 'VBE.*.is_healthy')]
+
+        # Replace globs sharing the same literal stem (e.g. 'MAIN' in
+        # 'MAIN.foo') by a single '<stem>.*' one when there are lots of them:
+        # varnishstat tries all globs against every counter.
+        stems, counts = {}, {}
+        for glob in globs:
+            stem = stems[glob] = heads[glob].rpartition('.')[0]
+            counts[stem] = counts.get(stem, 0) + 1
+        globs = [
+            _glob_escape(stems[glob]) + '.*'
+            if stems[glob] and counts[stems[glob]] > VARNISHSTAT_GLOBS_PER_STEM
+            else glob
+            for glob in globs]
+        heads.update((glob, _glob_head(glob)) for glob in globs)
+
+        # Narrow globs using exclusions like '^<literal>' or
+        # '^<literal>(?!<literal>)' (e.g. the default one, keeping just the
+        # 'std' accounting namespace). Other exclusions are only applied by
+        # this script. Inclusions go first: depending on the varnishstat
+        # release, the first glob decides if counters not matching any glob
+        # are included.
+        exclusion = _literal_exclusion(exclusions.pattern)
+        if exclusion is not None:
+            prefix, allowed = exclusion
+            result, excluded = [], []
+            for glob in globs:
+                head = heads[glob]
+                wildcard = _glob_escape(head) != glob
+                if head.startswith(prefix):
+                    rest = head[len(prefix):]
+                    if allowed is not None:
+                        if rest.startswith(allowed):
+                            result.append(glob)
+                        elif allowed.startswith(rest) and wildcard:
+                            result.append(_glob_escape(prefix + allowed) + '*')
+                else:
+                    result.append(glob)
+                    if allowed is None and prefix.startswith(head) and wildcard:
+                        excluded = ['^' + _glob_escape(prefix) + '*']
+            globs = result + excluded
+
+        # Remove duplicates.
+        seen = set()
+        globs = [glob for glob in globs if not (glob in seen or seen.add(glob))]
     else:
-        stats.log(output)
-
-    # Done!
-    return stats
+        globs = []
+
+    _VARNISHSTAT_FILTERS[key] = globs
+    return globs
+
+
+def _subject_prefixes(subject):
+    # Return the set of leading segments of raw names that may end up being
+    # of a subject type after rewrites (e.g. 'STG', 'MSE', 'SMA' & 'SMF' for
+    # 'storages'), or None if that can't be determined.
+    result = _prefixes(SUBJECTS[subject]) if SUBJECTS[subject] is not None else None
+    if result is None:
+        return None
+    result = set(result)
+    while True:
+        size = len(result)
+        for pattern, repl in REWRITES:
+            head = re.match(r'^\w*', repl).group(0)
+            if not head or _prefixes(pattern) is None:
+                return None
+            if head in result:
+                result.update(_prefixes(pattern))
+        if len(result) == size:
+            return result
+
+
+def _literal_exclusion(pattern):
+    # Return a (prefix, allowed) tuple for exclusions like '^<prefix>' or
+    # '^<prefix>(?!<allowed>)' matching names that are never rewritten (i.e.
+    # exclusions can be checked against raw names), or None otherwise.
+    literal = r'((?:\\[^\w\s]|[\w\-])+)'
+    match = re.match(r'^\^?' + literal + r'(?:\(\?!' + literal + r'\))?$', pattern)
+    if match is None:
+        return None
+    prefix, allowed = [
+        _unescape(value) if value is not None else None
+        for value in match.groups()]
+    for rewrite, repl in REWRITES:
+        prefixes = _prefixes(rewrite)
+        if prefixes is None:
+            return None
+        for value in set(prefixes) | set([re.match(r'^\w*', repl).group(0)]):
+            if not value or value.startswith(prefix) or prefix.startswith(value + '.'):
+                return None
+    return prefix, allowed
+
+
+def _varnishstat_counters(stats, instance, filters):
+    # Return an iterator of (name, flag, value) tuples for all counters
+    # reported by varnishstat (restricted to the given 'varnishstat -f'
+    # globs), or None if it failed. Output is parsed while being read, so it is
+    # never fully held in memory.
+    import subprocess
+    import tempfile
+
+    arguments = []
+    for glob in filters:
+        arguments.extend(['-f', glob])
+    errors = tempfile.TemporaryFile()
+    child = subprocess.Popen(
+        ['varnishstat', '-1', '-j', '-n', instance] + arguments,
+        stdout=subprocess.PIPE,
+        stderr=errors,
+        start_new_session=True)
+    timer = _supervise(child)
+    chunk = child.stdout.read(io.DEFAULT_BUFFER_SIZE)
+
+    def error():
+        child.stdout.close()
+        _wait(child)
+        if timer is not None:
+            timer.cancel()
+        errors.seek(0)
+        stats.log(errors.read().decode('utf-8', 'replace'))
+        errors.close()
 
+    # Error recovering information from varnishstat.
+    if not chunk:
+        error()
+        return None
 
-def _backend_stats(stats, instance):
+    def counters():
+        try:
+            for name, data in _json_object_items(chunk, child.stdout):
+                # Filter invalid items.
+                if isinstance(data, dict) and 'value' in data:
+                    yield name, data['flag'], data['value']
+        except ValueError as e:
+            stats.log('Failed to parse varnishstat output: {}'.format(e))
+        finally:
+            child.stdout.close()
+            if _wait(child) != 0:
+                error()
+            else:
+                errors.close()
+                if timer is not None:
+                    timer.cancel()
+
+    return counters()
+
+
+def _json_object_items(chunk, stream):
+    # Incrementally parse a JSON object from a binary stream (whose first
+    # 'chunk' has already been read), yielding its (key, value) pairs as soon
+    # as they are complete.
+    import codecs
+
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer, position, eof = utf8.decode(chunk), 0, False
+    expected = '{'
+    while True:
+        # Skip whitespace, reading more data if needed.
+        while position < len(buffer) and buffer[position] in ' \t\r\n':
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise ValueError('Unexpected end of JSON object')
+            buffer, position = buffer[position:], 0
+            chunk = stream.read(io.DEFAULT_BUFFER_SIZE)
+            buffer += utf8.decode(chunk, final=not chunk)
+            eof = not chunk
+            continue
+
+        # Object delimiters.
+        char = buffer[position]
+        if expected == '{':
+            if char != '{':
+                raise ValueError('Expected JSON object')
+            expected, position = 'key', position + 1
+            continue
+        if char == '}' and expected in ('key', ','):
+            return
+        if expected == ',':
+            if char != ',':
+                raise ValueError('Expected "," at position {}'.format(position))
+            expected, position = 'key', position + 1
+            continue
+
+        # Key & value. If any of them is incomplete (or may be, e.g. a number
+        # at the end of the buffer), read more data and try again.
+        try:
+            key, end = decoder.raw_decode(buffer, position)
+            while end < len(buffer) and buffer[end] in ' \t\r\n':
+                end += 1
+            if end == len(buffer) or buffer[end] != ':':
+                raise ValueError('Expected ":"')
+            end += 1
+            while end < len(buffer) and buffer[end] in ' \t\r\n':
+                end += 1
+            value, end = decoder.raw_decode(buffer, end)
+            if end == len(buffer) and not eof:
+                raise ValueError('Possibly incomplete value')
+        except ValueError:
+            if eof:
+                raise
+            buffer, position = buffer[position:], 0
+            chunk = stream.read(io.DEFAULT_BUFFER_SIZE)
+            buffer += utf8.decode(chunk, final=not chunk)
+            eof = not chunk
+            continue
+        yield key, value
+        expected, position = ',', end
+
+
+def _vsm_counters(stats, instance):
+    # Return (name, flag, value) tuples for all counters accepted by 'stats'
+    # reading them directly from the VSM segments of the instance (i.e. what
+    # varnishstat does under the hood), or None if that is not possible. Only
+    # 'Stat' & 'StatDoc' segments are mapped (read-only), and values are read
+    # only for counters matching the items definitions (plus 'VBE.*.is_healthy'
+    # counters, see _backend_stats()).
+    import mmap
+    import struct
+
+    maps = {}
+    try:
+        # Locate counter & documentation segments for both the management &
+        # child processes.
+        segments, docs = [], {}
+        for directory in ('_.vsm_mgt', '_.vsm_child'):
+            path = os.path.join(_workdir(instance), directory)
+            for filename, offset, length, klass, ident in _vsm_segments(path):
+                if klass not in ('Stat', 'StatDoc'):
+                    continue
+                filename = os.path.join(path, filename)
+                if filename not in maps:
+                    with open(filename, 'rb') as fd:
+                        maps[filename] = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                data = maps[filename]
+
+                # All segments start with a 'struct vsc_head' (ready flag, body
+                # offset & doc id). Not yet ready segments are ignored.
+                ready, body_offset, doc = struct.unpack_from('=QQQ', data, offset)
+                if ready:
+                    if klass == 'Stat':
+                        segments.append((ident, data, offset, length, body_offset, doc))
+                    else:
+                        docs[doc] = _vsm_doc(data[offset + body_offset:offset + length])
+
+        # Old releases (6.0) don't use separate 'StatDoc' segments. In that
+        # case the JSON documentation is found inside the 'Stat' segment itself,
+        # at the offset stored in the head.
+        result = []
+        for ident, data, offset, length, body_offset, doc in segments:
+            if docs:
+                definition = docs.get(doc)
+            else:
+                definition = _vsm_doc(data[offset + doc:offset + length])
+            if definition is None:
+                continue
+            for element in definition['elem'].values():
+                name = ident + '.' + element['name']
+                if stats.accepts(name) or name.endswith('.is_healthy'):
+                    result.append((
+                        name,
+                        VSM_FLAGS.get(element['type'], element['type'][:1]),
+                        struct.unpack_from(
+                            '=Q', data, offset + body_offset + int(element['index']))[0]))
+        return result
+    except (IOError, OSError, ValueError, KeyError, TypeError, struct.error) as e:
+        stats.log('Failed to read counters from the VSM: {}'.format(e))
+        return None
+    finally:
+        for value in maps.values():
+            value.close()
+
+
+def _vsm_doc(data):
+    # Parse a (NUL terminated) JSON counters documentation.
+    return json.loads(data.split(b'\0', 1)[0].decode('utf-8'))
+
+
+def _backend_stats(stats, instance, cli, options):
+    # Return the set of backends of the active VCL (or None if unknown) and
+    # the state of the backends cache (or None if not enabled). When the set
+    # is reused from the cache no 'healthy' items are added here.
     backends = None
+    cache = _backends_cache(instance, cli, options)
+    if cache is not None and cache['backends'] is not None:
+        return set(cache['backends']), cache
 
     # XXX: since VCP 6.0.6r8 the 'is_healthy' item is included in varnishstat's
     # output. However fetching the list of backends through varnishadm is still
@@ -662,7 +2274,7 @@ def _backend_stats(stats, instance):
     # XXX: since VCP 6.0.8r4 a '-j' option is included that could easen parsing.
     # To be used when that version is widely adopted.
 
-    rc, output = _execute('varnishadm -n "{}" backend.list'.format(instance))
+    rc, output = _varnishadm(instance, cli, 'backend.list')
     if rc == 0:
         backends = set()
         for line in output.split('\n')[1:]:
@@ -679,23 +2291,82 @@ def _backend_stats(stats, instance):
     else:
         stats.log(output)
 
-    return backends
+    return backends, cache
+
+
+def _backends_cache(instance, cli, options):
+    # Return the state of the backends cache: path, fingerprint of the current
+    # VCL state and, if the cached backends are still valid for that state,
+    # the list of backends. The fingerprint is based on the 'vcl.list' output
+    # (i.e. names, status & temperature of all VCLs, ignoring busy counters),
+    # which changes after any VCL load, use or discard.
+    if options.backends_ttl <= 0:
+        return None
+    import hashlib
+
+    rc, output = _varnishadm(instance, cli, 'vcl.list')
+    if rc != 0:
+        return None
+    active = None
+    for line in output.split('\n'):
+        fields = line.split()
+        if len(fields) > 3 and fields[0] == 'active':
+            active = fields[3]
+    fingerprint = hashlib.sha1('\n'.join(
+        ' '.join(field for field in line.split() if not field.isdigit())
+        for line in output.split('\n')).encode('utf-8')).hexdigest()
+
+    path = _state_path(options, instance, 'backends')
+    try:
+        with _open_state(path, 'r') as fd:
+            state = json.load(fd)
+    except (IOError, ValueError):
+        state = {}
+    valid = \
+        state.get('fingerprint') == fingerprint and \
+        0 <= time.time() - state.get('timestamp', 0) < options.backends_ttl
+
+    return {
+        'path': path,
+        'fingerprint': fingerprint,
+        'active': active,
+        'n_backend': state.get('n_backend'),
+        'backends': state.get('backends') if valid and active is not None else None,
+    }
 
 
-def _pid(instance):
+def _update_backends_cache(stats, cache, backends, reused, healthy):
+    # Persist the list of backends fetched through varnishadm, or invalidate
+    # the cache when reusing it is not safe: 'VBE.*.is_healthy' counters are
+    # needed to replace the health reported by 'backend.list', and a different
+    # number of backends (e.g. dynamic backends) means the list is outdated.
+    n_backend = stats.get('MAIN.n_backend')
+    if backends is None or not healthy or (reused and n_backend != cache['n_backend']):
+        try:
+            os.unlink(cache['path'])
+        except OSError:
+            pass
+    elif not reused:
+        _write_json(cache['path'], {
+            'fingerprint': cache['fingerprint'],
+            'timestamp': time.time(),
+            'n_backend': n_backend,
+            'backends': sorted(backends),
+        })
+
+
+def _pid(instance, cli):
     # Since VCP 6.0.6r7 it is possible to conveniently extract the worker PID
     # through varnishadm. For lower versions of VCP 6.x this information may
     # be extracted from an index file. For even lower versions (4.1) no PID
     # is returned.
     pid = None
-    rc, output = _execute('varnishadm -n "{}" pid -j'.format(instance))
+    rc, output = _varnishadm(instance, cli, 'pid', '-j')
     if rc == 0:
         pid = int(json.loads(output)[3]['worker'])
     else:
         try:
-            with open('/var/lib/varnish/%(name)s/_.vsm_child/_.index' % {
-                'name': instance or socket.gethostname()
-            }) as f:
+            with open(os.path.join(_workdir(instance), '_.vsm_child', '_.index')) as f:
                 pid = int(f.readline().split(' ')[1])
         except IOError:
             pass
@@ -709,7 +2380,7 @@ def _memory_stats(stats, pid):
     #   - https://www.zabbix.com/documentation/5.0/manual/appendix/items/proc_mem_notes
     #   - https://unix.stackexchange.com/questions/199482/does-proc-pid-status-always-use-kb
     try:
-        with open('/proc/{}/statm'.format(pid), 'r') as fd:
+        with open(os.path.join(PROC_DIR, str(pid), 'statm'), 'r') as fd:
             fields = fd.read().split()
             page_size = getpagesize()
 
@@ -764,10 +2435,10 @@ def _memory_stats(stats, pid):
                 value=int(fields[5]) * page_size,
                 type=TYPE_GAUGE))
     except:
-        stats.log('Failed to fetch /proc/{}/statm stats'.format(pid))
+        stats.log('Failed to fetch {}/{}/statm stats'.format(PROC_DIR, pid))
 
     try:
-        with open('/proc/{}/status'.format(pid), 'r') as fd:
+        with open(os.path.join(PROC_DIR, str(pid), 'status'), 'r') as fd:
             items = re.compile(r'^(VmSwap):\s*(\d+)\s*kB$')
             for line in fd:
                 match = items.match(line)
@@ -784,38 +2455,663 @@ def _memory_stats(stats, pid):
                             type=TYPE_GAUGE))
                         break
     except:
-        stats.log('Failed to fetch /proc/{}/status stats'.format(pid))
+        stats.log('Failed to fetch {}/{}/status stats'.format(PROC_DIR, pid))
+
+
+def _proc_stat(stats, pid):
+    # Linux is assumed. See:
+    #   - man proc
+    # Fields of /proc/<PID>/stat following the process name (i.e. 'comm',
+    # which may include spaces & parentheses), so field #3 ('state') is at
+    # index 0. Read once & shared by all collectors using it.
+    try:
+        with open(os.path.join(PROC_DIR, str(pid), 'stat'), 'rb') as fd:
+            return fd.read().rpartition(b')')[2].split()
+    except:
+        stats.log('Failed to fetch {}/{}/stat stats'.format(PROC_DIR, pid))
+        return None
+
 
+def _page_fault_stats(stats, proc_stat):
+    # 'minflt' (#10) & 'majflt' (#12) in /proc/<PID>/stat.
+    if proc_stat is not None and len(proc_stat) > 9:
+        stats.add(Item(
+            name='PAGE_FAULTS.minor',
+            value=int(proc_stat[7]),
+            type=TYPE_COUNTER))
+        stats.add(Item(
+            name='PAGE_FAULTS.major',
+            value=int(proc_stat[9]),
+            type=TYPE_COUNTER))
 
-def _page_fault_stats(stats, pid):
+
+def _thread_stats(stats, pid, proc_stat):
     # Linux is assumed. See:
     #   - man proc
+    # CPU time of the worker process ('utime' (#14) & 'stime' (#15) in
+    # /proc/<PID>/stat), plus context switches & CPU time of its threads,
+    # grouped by name (e.g. 'cache-worker', 'cache-acceptor', 'cache-epoll').
+    # There may be thousands of threads, so task entries are opened relative
+    # to a single directory descriptor.
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    if proc_stat is not None and len(proc_stat) > 12:
+        stats.add(Item(
+            name='CPU.user',
+            value=round(int(proc_stat[11]) / ticks, 2),
+            type=TYPE_COUNTER))
+        stats.add(Item(
+            name='CPU.system',
+            value=round(int(proc_stat[12]) / ticks, 2),
+            type=TYPE_COUNTER))
+
+    try:
+        directory = os.open(
+            os.path.join(PROC_DIR, str(pid), 'task'), os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        stats.log('Failed to fetch {}/{}/task stats'.format(PROC_DIR, pid))
+        return
     try:
-        with open('/proc/{}/stat'.format(pid), 'r') as fd:
+        switches = re.compile(br'^(voluntary|nonvoluntary)_ctxt_switches:\s*(\d+)', re.M)
+        voluntary, involuntary, groups = 0, 0, {}
+        for tid in os.listdir(directory):
+            try:
+                task_stat = _read_task_file(directory, tid + '/stat')
+                task_status = _read_task_file(directory, tid + '/status')
+            except OSError:
+                # Thread exited while scanning.
+                continue
+
+            # Context switches ('voluntary_ctxt_switches' &
+            # 'nonvoluntary_ctxt_switches' in /proc/<PID>/task/<TID>/status)
+            # are only reported per thread, so they are summed for all
+            # current threads. Switches of exited threads are lost, so sums
+            # may decrease and are reported as gauges.
+            for kind, value in switches.findall(task_status):
+                if kind == b'voluntary':
+                    voluntary += int(value)
+                else:
+                    involuntary += int(value)
+
+            # Thread name (i.e. 'comm', which may include spaces & parentheses)
+            # and 'utime' & 'stime' (clock ticks) in
+            # /proc/<PID>/task/<TID>/stat. Numbered threads (e.g. MSE I/O
+            # threads) are grouped by their common name. As above, sums only
+            # include current threads and are reported as gauges ('CPU.*'
+            # items are the process-wide counters).
+            head, _, tail = task_stat.rpartition(b')')
+            name = head.partition(b'(')[2].decode('utf-8', 'replace')
+            name = re.sub(r'[\s\-_:/#.]*\d+$', '', name) or name
+            fields = tail.split()
+            group = groups.setdefault(name, [0, 0, 0])
+            group[0] += 1
+            group[1] += int(fields[11])
+            group[2] += int(fields[12])
+    except:
+        stats.log('Failed to fetch {}/{}/task stats'.format(PROC_DIR, pid))
+        return
+    finally:
+        os.close(directory)
+
+    stats.add(Item(
+        name='CONTEXT_SWITCHES.voluntary',
+        value=voluntary,
+        type=TYPE_GAUGE))
+    stats.add(Item(
+        name='CONTEXT_SWITCHES.involuntary',
+        value=involuntary,
+        type=TYPE_GAUGE))
+    for name, (count, user, system) in groups.items():
+        for metric, value, type in (
+                ('threads', count, TYPE_GAUGE),
+                ('cpu_user', round(user / ticks, 2), TYPE_GAUGE),
+                ('cpu_system', round(system / ticks, 2), TYPE_GAUGE)):
+            stats.add(Item(
+                name='THREADS.{}.{}'.format(name, metric),
+                value=value,
+                type=type,
+                subject_type='threads',
+                subject_value=name))
+
+
+def _read_task_file(directory, path):
+    # Read a /proc file relative to a directory descriptor. Sizes reported by
+    # /proc are meaningless, so it's read until EOF (usually a single read()
+    # is enough).
+    fd = os.open(path, os.O_RDONLY, dir_fd=directory)
+    try:
+        chunks = []
+        while True:
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+    finally:
+        os.close(fd)
+
+
+def _io_stats(stats, pid):
+    # Linux is assumed. See:
+    #   - man proc
+    # 'read_bytes' & 'write_bytes' in /proc/<PID>/io: bytes actually fetched
+    # from / sent to the storage layer by the worker process (i.e. page cache
+    # hits are not included).
+    try:
+        with open(os.path.join(PROC_DIR, str(pid), 'io'), 'r') as fd:
             for line in fd:
-                fields = line.split(' ')
-                if len(fields) > 11:
+                name, _, value = line.partition(':')
+                if name in ('read_bytes', 'write_bytes'):
                     stats.add(Item(
-                        name='PAGE_FAULTS.minor',
-                        value=int(fields[9]),
+                        name='IO.' + name,
+                        value=int(value),
                         type=TYPE_COUNTER))
-                    stats.add(Item(
-                        name='PAGE_FAULTS.major',
-                        value=int(fields[11]),
-                        type=TYPE_COUNTER))
-                    break
     except:
-        stats.log('Failed to fetch /proc/{}/stat stats'.format(pid))
+        stats.log('Failed to fetch {}/{}/io stats'.format(PROC_DIR, pid))
+
+
+def _cgroup_stats(stats, pid):
+    # Linux & cgroup v2 are assumed. See:
+    #   - https://docs.kernel.org/admin-guide/cgroup-v2.html
+    #   - https://docs.kernel.org/accounting/psi.html
+    # Stats of the cgroup of the worker process (e.g. the systemd service):
+    # pressure stall information, selected 'memory.stat' fields & I/O per
+    # block device. Missing files (e.g. cgroup v1 hosts, disabled controllers
+    # or PSI) are silently ignored.
+    path = None
+    try:
+        with open(os.path.join(PROC_DIR, str(pid), 'cgroup'), 'r') as fd:
+            for line in fd:
+                if line.startswith('0::'):
+                    path = os.path.join(
+                        SYS_DIR, 'fs', 'cgroup', line[3:].strip().lstrip('/'))
+                    break
+    except IOError:
+        pass
+    if path is None:
+        return
+
+    def read(name):
+        try:
+            with open(os.path.join(path, name), 'r') as fd:
+                return fd.read()
+        except (IOError, OSError):
+            return None
+
+    try:
+        # 'cpu.pressure', 'memory.pressure' & 'io.pressure': share of time
+        # (percentage averages over 10, 60 & 300 seconds, and total stall
+        # time, in seconds) during which some or all tasks were stalled.
+        for resource in ('cpu', 'memory', 'io'):
+            for line in (read(resource + '.pressure') or '').splitlines():
+                fields = line.split()
+                for field in fields[1:]:
+                    name, _, value = field.partition('=')
+                    if name == 'total':
+                        value, type = round(int(value) / 1e6, 6), TYPE_COUNTER
+                    else:
+                        value, type = float(value), TYPE_GAUGE
+                    stats.add(Item(
+                        name='PRESSURE.{}.{}_{}'.format(resource, fields[0], name),
+                        value=value,
+                        type=type))
+
+        # 'memory.current' & selected 'memory.stat' fields (bytes for
+        # amounts of memory, number of events for everything else).
+        value = read('memory.current')
+        if value is not None:
+            stats.add(Item(
+                name='CGROUP_MEMORY.current',
+                value=int(value),
+                type=TYPE_GAUGE))
+        for line in (read('memory.stat') or '').splitlines():
+            name, _, value = line.partition(' ')
+            if name in CGROUP_MEMORY_STATS:
+                stats.add(Item(
+                    name='CGROUP_MEMORY.' + name,
+                    value=int(value),
+                    type=CGROUP_MEMORY_STATS[name]))
+
+        # 'io.stat': bytes & operations (read, write & discard) per block
+        # device, named after the device (e.g. 'sda') when possible. Values
+        # are parsed one by one, so a malformed one doesn't discard the rest.
+        for line in (read('io.stat') or '').splitlines():
+            fields = line.split()
+            if not fields:
+                continue
+            try:
+                device = os.path.basename(os.readlink(
+                    os.path.join(SYS_DIR, 'dev', 'block', fields[0])))
+            except OSError:
+                device = fields[0]
+            for field in fields[1:]:
+                name, _, value = field.partition('=')
+                if name not in CGROUP_IO_STATS:
+                    continue
+                try:
+                    value = int(value)
+                except ValueError:
+                    stats.log('Failed to parse {} in {}/io.stat'.format(field, path))
+                    continue
+                stats.add(Item(
+                    name='CGROUP_IO.{}.{}'.format(device, name),
+                    value=value,
+                    type=TYPE_COUNTER,
+                    subject_type='devices',
+                    subject_value=device))
+    except ValueError:
+        stats.log('Failed to parse cgroup stats of {}'.format(path))
+
+
+class Histogram(object):
+    '''
+    A fixed-memory histogram of durations using the log-spaced buckets in
+    LATENCY_BUCKETS: keeps cumulative counts per bucket, plus counts per bucket
+    and maximum of the current window, and of the last completed one, used to
+    estimate percentiles.
+    '''
+
+    __slots__ = ('counts', 'window', 'maximum', 'published')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.window = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.maximum = 0.0
+        self.published = None
+
+    def add(self, value):
+        i = bisect.bisect_left(LATENCY_BUCKETS, value)
+        self.counts[i] += 1
+        self.window[i] += 1
+        if value > self.maximum:
+            self.maximum = value
+
+    def rotate(self, consecutive):
+        # Start a new window, publishing the current one only if the new one
+        # immediately follows it (i.e. nothing is published after an idle
+        # window).
+        self.published = (self.window, self.maximum) if consecutive else None
+        self.window = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.maximum = 0.0
+
+    def summary(self):
+        # Return (name, value) pairs for percentiles & maximum of the last
+        # completed window (nothing if there is none or it was empty).
+        result = []
+        if self.published is not None:
+            window, maximum = self.published
+            total = sum(window)
+            if total > 0:
+                for name, quantile in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+                    result.append((name, round(
+                        self._quantile(window, maximum, quantile, total), 6)))
+                result.append(('max', round(maximum, 6)))
+        return result
+
+    def _quantile(self, window, maximum, quantile, total):
+        # Interpolate linearly inside the bucket holding the requested rank.
+        # The +Inf bucket is assumed to end at the window maximum.
+        rank = quantile * total
+        seen = 0
+        for i, count in enumerate(window):
+            if count > 0 and seen + count >= rank:
+                lower = LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+                upper = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else maximum
+                return min(
+                    maximum,
+                    lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return maximum
+
+
+class Latencies(object):
+    '''
+    Latency histograms of a Varnish Cache instance (and, optionally, of each of
+    its backends) fed from 'varnishlog' output. No per-request state is kept:
+    every 'Timestamp' record is folded into a histogram as soon as it's read.
+
+    Percentiles are computed over fixed windows of 'interval' seconds aligned
+    to the clock (the wall clock when tailing, timestamps of records when
+    replaying), so they don't depend on when or how often they are read: all
+    readers get the last completed window.
+    '''
+
+    def __init__(self, backends=False, interval=60, replay=False):
+        self._lock = threading.Lock()
+        self.backends = backends
+        self._interval = interval
+        self._replay = replay
+        self._window = None
+        self._histograms = {}
+
+    def feed(self, stream):
+        # Parse 'varnishlog' output (text format, default 'vxid' grouping)
+        # from a binary stream. The only state is the backend of the current
+        # transaction, reset on every transaction header.
+        backend = None
+        for line in stream:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            if fields[0][:1] == b'*':
+                backend = None
+            elif fields[1] == b'Timestamp':
+                timestamp = LATENCY_TIMESTAMPS.get(fields[2])
+                if timestamp is None or len(fields) <= timestamp[1]:
+                    continue
+                name, position = timestamp
+                if name is None:
+                    if backend is None:
+                        continue
+                    key = (backend, 'latency')
+                else:
+                    key = (None, name)
+                try:
+                    value = float(fields[position])
+                    now = float(fields[3]) if self._replay else time.time()
+                except ValueError:
+                    continue
+                with self._lock:
+                    self._rotate(now)
+                    histogram = self._histograms.get(key)
+                    if histogram is None:
+                        # Bound memory usage when backends are created
+                        # dynamically (e.g. goto VMOD).
+                        if key[0] is not None and len(self._histograms) >= LATENCY_BACKENDS_MAX:
+                            continue
+                        histogram = self._histograms[key] = Histogram()
+                    histogram.add(value)
+            elif self.backends and fields[1] in (b'BackendOpen', b'BackendReuse'):
+                backend = fields[3].decode('utf-8', 'replace') if len(fields) > 3 else None
+
+    def close(self):
+        # Complete the current window (e.g. at the end of a replay).
+        with self._lock:
+            if self._window is not None:
+                self._rotate((self._window + 1) * self._interval)
+
+    def items(self):
+        # Return (name, value, type) tuples for all histograms:
+        # 'LATENCY.<name>.*' items, including cumulative bucket counts
+        # ('le_<upper bound in microseconds>'), and 'VBE.<backend>.latency_*'
+        # items, without bucket counts.
+        result = []
+        with self._lock:
+            if not self._replay:
+                self._rotate(time.time())
+            for (backend, name), histogram in self._histograms.items():
+                if backend is None:
+                    prefix = 'LATENCY.{}.'.format(name)
+                    total = 0
+                    for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                        total += count
+                        result.append((
+                            '{}le_{}'.format(prefix, int(round(bound * 1000000))),
+                            total,
+                            TYPE_COUNTER))
+                else:
+                    prefix = 'VBE.{}.{}_'.format(backend, name)
+                result.append((prefix + 'count', sum(histogram.counts), TYPE_COUNTER))
+                for suffix, value in histogram.summary():
+                    result.append((prefix + suffix, value, TYPE_GAUGE))
+        return result
+
+    def _rotate(self, now):
+        # Switch to the window including 'now' if needed. Must be called
+        # holding the lock.
+        window = int(now // self._interval)
+        if self._window is None:
+            self._window = window
+        elif window > self._window:
+            for histogram in self._histograms.values():
+                histogram.rotate(window == self._window + 1)
+            self._window = window
+
+
+_LATENCIES = {}
+_LATENCIES_LOCK = threading.Lock()
+
+
+def _latencies(instance, options):
+    # Return the latency histograms of an instance, or None if not enabled.
+    # Histograms live in the process: long-running commands ('serve' &
+    # 'exporter') feed them in the background tailing varnishlog (or replaying
+    # --latency-replay), while other commands can only replay a recorded file,
+    # synchronously.
+    with _LATENCIES_LOCK:
+        latencies = _LATENCIES.get(instance)
+        if latencies is None and options.latency:
+            if options.command in ('serve', 'exporter'):
+                latencies = _LATENCIES[instance] = Latencies(
+                    options.latency_backends, options.latency_window,
+                    options.latency_replay is not None)
+                thread = threading.Thread(
+                    target=_tail_latencies,
+                    args=(instance, latencies, options.latency_replay))
+                thread.daemon = True
+                thread.start()
+            elif options.latency_replay is not None:
+                latencies = _LATENCIES[instance] = Latencies(
+                    options.latency_backends, options.latency_window, True)
+                _tail_latencies(instance, latencies, options.latency_replay)
+    return latencies
+
+
+def _tail_latencies(instance, latencies, path=None):
+    # Feed latency histograms from a recorded 'varnishlog' output file, or
+    # from a 'varnishlog' child process (restarted whenever it exits) only
+    # reporting the records needed.
+    import subprocess
+
+    if path is not None:
+        try:
+            with open(path, 'rb') as fd:
+                latencies.feed(fd)
+            latencies.close()
+        except IOError as e:
+            sys.stderr.write('Failed to replay "{}": {}\n'.format(path, e))
+        return
+
+    while True:
+        started = time.time()
+        try:
+            child = subprocess.Popen(
+                ['varnishlog', '-n', instance,
+                 '-i', 'BackendOpen,BackendReuse',
+                 '-I', 'Timestamp:^(?:{}) '.format('|'.join(
+                     label.decode('utf-8')
+                     for label, (name, _) in sorted(LATENCY_TIMESTAMPS.items())
+                     if name is not None or latencies.backends))],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL)
+            try:
+                latencies.feed(child.stdout)
+            finally:
+                child.stdout.close()
+                child.wait()
+        except OSError as e:
+            sys.stderr.write('Failed to execute varnishlog for instance "{}": {}\n'.format(
+                instance, e))
+        time.sleep(max(0, 5 - (time.time() - started)))
+
+
+class VarnishCLI(object):
+    '''
+    A minimal client of the varnishd management CLI (i.e. what varnishadm does
+    under the hood): connects to the -T address, authenticates using the -S
+    secret and executes any number of commands over the same connection.
+    '''
+
+    def __init__(self, addresses, secret=None, timeout=SOCKET_TIMEOUT):
+        self._addresses = addresses
+        self._secret = secret
+        self._timeout = timeout
+        self._socket = None
+        self._file = None
+        self._failed = False
+
+    @classmethod
+    def from_vsm(cls, instance, timeout=SOCKET_TIMEOUT):
+        # Locate -T & -S arguments in the VSM of the management process, just
+        # like varnishadm does when only -n is provided.
+        arguments = _vsm_arguments(os.path.join(_workdir(instance), '_.vsm_mgt'))
+        if not arguments.get('-T'):
+            raise IOError('No -T argument found in the VSM of instance "{}"'.format(instance))
+        addresses = [
+            tuple(line.rsplit(' ', 1))
+            for line in arguments['-T'].splitlines() if ' ' in line]
+        secret = None
+        if arguments.get('-S'):
+            with open(arguments['-S'], 'rb') as fd:
+                secret = fd.read()
+        return cls(addresses, secret, timeout)
+
+    def connect(self):
+        # Try all -T addresses until one of them accepts the connection. Once
+        # connecting fails, no further attempts are made.
+        import socket
+
+        if self._failed:
+            raise IOError('Failed to connect to the CLI')
+        self._failed = True
+        error = None
+        for host, port in self._addresses:
+            try:
+                self._socket = socket.create_connection((host, int(port)), self._timeout)
+                break
+            except (OSError, ValueError) as e:
+                error = e
+        else:
+            raise IOError('Failed to connect to the CLI: {}'.format(error))
+        self._file = self._socket.makefile('rwb')
+
+        # Read banner, solving the authentication challenge if needed.
+        status, body = self._read()
+        if status == 107:
+            if self._secret is None:
+                raise IOError('CLI authentication required but no secret available')
+            challenge = body[:32].encode('utf-8')
+            import hashlib
+            response = hashlib.sha256(
+                challenge + b'\n' + self._secret + challenge + b'\n').hexdigest()
+            status, body = self.execute('auth', response)
+        if status != 200:
+            raise IOError('CLI handshake failed ({}): {}'.format(status, body.strip()))
+        self._failed = False
+
+    def execute(self, *args):
+        # Execute a command and return its status & body.
+        if self._file is None:
+            self.connect()
+        self._file.write((' '.join(_cli_quote(arg) for arg in args) + '\n').encode('utf-8'))
+        self._file.flush()
+        return self._read()
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                self._file.close()
+                self._socket.close()
+            except OSError:
+                pass
+        self._socket = self._file = None
+
+    def _read(self):
+        # Responses are framed by a fixed size status line ('%-3d %-8zd\n',
+        # i.e. status & body length) followed by the body and a newline.
+        header = self._file.read(13)
+        if len(header) != 13:
+            raise IOError('Unexpected end of CLI response')
+        status, length = header.split()
+        body = self._file.read(int(length) + 1)
+        if len(body) != int(length) + 1:
+            raise IOError('Unexpected end of CLI response')
+        return int(status), body[:-1].decode('utf-8', 'replace')
+
+
+def _cli(instance):
+    # Return a VarnishCLI for the given instance, or None if it can't be
+    # located (e.g. not enough permissions to read the secret), in which case
+    # varnishadm will be used instead. Socket operations never outlive the
+    # deadline of the current collection, if any.
+    timeout = SOCKET_TIMEOUT
+    deadline = getattr(_DEADLINES, 'value', None)
+    if deadline is not None:
+        timeout = max(0.1, min(timeout, deadline - time.time()))
+    try:
+        return VarnishCLI.from_vsm(instance, timeout)
+    except (IOError, OSError, ValueError):
+        return None
+
 
+def _cli_quote(value):
+    # Quote a CLI command argument if needed.
+    if value and re.search(r'[\s"\\]', value) is None:
+        return value
+    return '"{}"'.format(
+        value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
 
-def _rewrite(name):
-    result = name
-    for pattern, repl in REWRITES:
-        if pattern.match(result):
-            result = pattern.sub(repl, result)
+
+def _vsm_arguments(path):
+    # Return a dict with the contents of all 'Arg' segments (i.e. -T, -S, etc.)
+    # registered in a VSM directory.
+    result = {}
+    for filename, offset, length, klass, ident in _vsm_segments(path):
+        if klass == 'Arg':
+            with open(os.path.join(path, filename), 'rb') as fd:
+                fd.seek(offset)
+                value = fd.read(length)
+            result[ident] = value.split(b'\0', 1)[0].decode('utf-8').strip()
     return result
 
 
+def _vsm_segments(path):
+    # Return (file, offset, length, class, ident) for all live segments
+    # registered in the index of a VSM directory. Index lines are formatted as
+    # '[+|-] <file> <offset> <length> <class> <ident>' (the leading action is
+    # missing in older releases). Removals ('-') cancel previous additions.
+    segments = {}
+    with open(os.path.join(path, '_.index'), 'r') as fd:
+        for line in fd:
+            fields = line.split()
+            if not fields or fields[0] == '#':
+                continue
+            action = '+'
+            if fields[0] in ('+', '-'):
+                action = fields.pop(0)
+            if len(fields) < 5:
+                continue
+            key = (fields[0], int(fields[1]), int(fields[2]), fields[3], ' '.join(fields[4:]))
+            if action == '+':
+                segments[key] = key
+            else:
+                segments.pop(key, None)
+    return list(segments.values())
+
+
+def _varnishadm(instance, cli, *args):
+    # Execute a CLI command using the given VarnishCLI, if any, or varnishadm
+    # otherwise (or if the built-in client fails). Returns the same
+    # (status, output) as _execute().
+    if cli is not None:
+        try:
+            status, output = cli.execute(*args)
+            return 0 if status == 200 else status, output
+        except (IOError, OSError, ValueError):
+            cli.close()
+    return _execute('varnishadm -n "{}" {}'.format(
+        instance, ' '.join(_cli_quote(arg) for arg in args)))
+
+
+def _workdir(instance):
+    # Return the working directory of a Varnish Cache instance.
+    if os.path.isabs(instance):
+        return instance
+    if not instance:
+        import socket
+        instance = socket.gethostname()
+    return os.path.join('/var/lib/varnish', instance)
+
+
 def _safe_zabbix_string(value):
     # Return a modified version of 'value' safe to be used as part of:
     #   - A quoted key parameter (see https://www.zabbix.com/documentation/4.0/manual/config/items/item/key).
@@ -824,15 +3120,193 @@ def _safe_zabbix_string(value):
 
 
 def _execute(command, stdin=None):
+    import subprocess
+
     child = subprocess.Popen(
         command,
         shell=True,
         stdout=subprocess.PIPE,
         stdin=subprocess.PIPE,
-        stderr=subprocess.STDOUT)
-    output = child.communicate(
-        input=stdin.encode('utf-8') if stdin is not None else None)[0].decode('utf-8')
-    return child.returncode, output
+        stderr=subprocess.STDOUT,
+        start_new_session=True)
+    timer = _supervise(child)
+    try:
+        # Not using communicate(), which reaps the child itself. Inputs are
+        # small, so they are written before reading the output.
+        try:
+            if stdin is not None:
+                child.stdin.write(stdin.encode('utf-8'))
+            child.stdin.close()
+        except BrokenPipeError:
+            pass
+        output = child.stdout.read().decode('utf-8')
+        child.stdout.close()
+        returncode = _wait(child)
+    finally:
+        if timer is not None:
+            timer.cancel()
+    return returncode, output
+
+
+def _wait(child):
+    # Wait for a child process (instead of Popen.wait()) reaping it using
+    # wait4(), in order to account its CPU time (and the one of descendants
+    # it waited for) to the collection running in the current thread. Returns
+    # its exit code.
+    if child.returncode is None:
+        try:
+            _, status, usage = os.wait4(child.pid, 0)
+        except ChildProcessError:
+            return child.wait()
+        child.returncode = \
+            -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        _CHILDREN_CPU.value = \
+            getattr(_CHILDREN_CPU, 'value', 0.0) + usage.ru_utime + usage.ru_stime
+    return child.returncode
+
+
+def _supervise(child):
+    # Kill a child process (started in a new session, so including any
+    # process it spawned) once the deadline of the collection running in the
+    # current thread (if any) expires. Returns the timer, to be cancelled when
+    # the child is done.
+    import signal
+
+    deadline = getattr(_DEADLINES, 'value', None)
+    if deadline is None:
+        return None
+
+    def kill():
+        try:
+            os.killpg(child.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    timer = threading.Timer(max(0.0, deadline - time.time()), kill)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def _metrics(results):
+    # Render (instance, stats) pairs in the Prometheus text exposition format,
+    # line by line. Samples must be grouped by metric family, so they are
+    # sorted by family & instance (keeping the order of items of the same
+    # instance) and rendered as they go, one family at a time. Subjects become
+    # labels (e.g. 'VBE.foo.req' -> 'varnish_vbe_req{location="",backend="foo"}').
+    # Samples of a family whose items don't share a type (e.g. snapshots of
+    # different releases) are declared as untyped.
+    samples = []
+    for position, (instance, stats) in enumerate(results):
+        for item in stats.items:
+            family, subject_label = _metric(item)
+            samples.append((
+                family, position, item.type, subject_label, item.subject_value,
+                item.value))
+    samples.sort(key=lambda sample: sample[:2])
+
+    start = 0
+    while start < len(samples):
+        family, type = samples[start][0], samples[start][2]
+        end = start + 1
+        while end < len(samples) and samples[end][0] == family:
+            if samples[end][2] != type:
+                type = TYPE_OTHER
+            end += 1
+        yield '# TYPE {} {}\n'.format(family, METRIC_TYPES.get(type, 'untyped'))
+        for _, position, _, subject_label, subject_value, value in samples[start:end]:
+            labels = 'location="{}"'.format(_safe_label_value(results[position][0]))
+            if subject_label is not None:
+                labels += ',{}="{}"'.format(
+                    subject_label, _safe_label_value(subject_value))
+            yield '{}{{{}}} {}\n'.format(family, labels, value)
+        start = end
+
+
+def _metric(item):
+    # Return the metric family name & subject label name of an item. All
+    # subject patterns match names like '<prefix>.<subject>[.<metric>]'.
+    name, label = item.name, None
+    if item.subject_value is not None:
+        prefix = name.split('.', 1)[0]
+        if name[len(prefix) + 1:].startswith(item.subject_value):
+            name = prefix + name[len(prefix) + 1 + len(item.subject_value):]
+            label = re.sub(r's$', '', re.sub(r'ies$', 'y', item.subject_type))
+    return 'varnish_' + re.sub(r'[^a-z0-9_]', '_', name.lower()), label
+
+
+def _safe_label_value(value):
+    # Escape a Prometheus label value.
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _zabbix_send(host, port, data):
+    # Send values using the Zabbix sender protocol: a 'ZBXD' header, protocol
+    # flags (0x01) and the payload length (little endian, 8 bytes), followed
+    # by a 'sender data' JSON request. The response uses the same framing.
+    import socket
+    import struct
+
+    payload = json.dumps({
+        'request': 'sender data',
+        'data': data,
+        'clock': int(time.time()),
+    }, separators=(',', ':')).encode('utf-8')
+    connection = socket.create_connection((host, port), SOCKET_TIMEOUT)
+    try:
+        connection.sendall(b'ZBXD\x01' + struct.pack('<Q', len(payload)) + payload)
+        response = b''
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+    finally:
+        connection.close()
+
+    if len(response) < 13 or response[:4] != b'ZBXD':
+        raise ValueError('Invalid response from Zabbix server')
+    length = struct.unpack('<Q', response[5:13])[0]
+    return json.loads(response[13:13 + length].decode('utf-8'))
+
+
+def _address(value, default_port):
+    # Parse a 'host[:port]' address ('[::1]:port' for IPv6).
+    match = re.match(r'^(?:\[([^\]]+)\]|([^:]+))(?::(\d+))?$', value)
+    if match is None:
+        return value, default_port
+    return match.group(1) or match.group(2), int(match.group(3) or default_port)
+
+
+def _client(path, argv):
+    # Forward the command line to a collector daemon listening at 'path'.
+    # Returns None if the daemon is not available (or failed to process the
+    # request) so the caller can fall back to a direct collection.
+    import socket
+
+    chunks = []
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.settimeout(SOCKET_TIMEOUT)
+            client.connect(path)
+            client.sendall((json.dumps({'argv': argv}) + '\n').encode('utf-8'))
+            client.shutdown(socket.SHUT_WR)
+            while True:
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            client.close()
+    except OSError:
+        return None
+
+    status, _, output = b''.join(chunks).decode('utf-8').partition('\n')
+    if status != 'OK':
+        sys.stderr.write(output + '\n')
+        return None
+    return output
 
 
 def re_argtype(string):
@@ -842,11 +3316,25 @@ def re_argtype(string):
         raise ArgumentTypeError(e)
 
 
+def top_argtype(string):
+    subject, separator, limit = string.partition('=')
+    if not separator or subject not in SUBJECTS or SUBJECTS[subject] is None:
+        raise ArgumentTypeError(
+            'expected <subject type>=<number of subjects>: {}'.format(string))
+    try:
+        limit = int(limit)
+    except ValueError:
+        limit = -1
+    if limit < 0:
+        raise ArgumentTypeError('invalid number of subjects: {}'.format(string))
+    return subject, limit
+
+
 ###############################################################################
 ## MAIN
 ###############################################################################
 
-def main():
+def _parser():
     # Set up the base command line parser.
     parser = ArgumentParser()
     parser.add_argument(
@@ -858,6 +3346,136 @@ def main():
         type=re_argtype, default=EXCLUSIONS,
         help='regular expression to match stats to be excluded (defaults to'
              ' "{}")'.format(EXCLUSIONS))
+    parser.add_argument(
+        '-s', '--socket', dest='socket',
+        type=str, default=None,
+        help='UNIX socket of a collector daemon (see the \'serve\' command);'
+             ' \'stats\' and \'discover\' are answered by the daemon when'
+             ' available, falling back to a direct collection otherwise')
+    parser.add_argument(
+        '-m', '--max-age', dest='max_age',
+        type=int, default=0,
+        help='maximum age (in seconds) of a previous collection shared through'
+             ' the state directory to be reused instead of collecting stats'
+             ' again (defaults to 0, i.e. always collect)')
+    parser.add_argument(
+        '-d', '--state-dir', dest='state_dir',
+        type=str, default=STATE_DIR,
+        help='directory where snapshots and other state are persisted'
+             ' (defaults to "{}")'.format(STATE_DIR))
+    parser.add_argument(
+        '--rates', dest='rates',
+        action='store_true', default=False,
+        help='\'stats\' and \'send\' also emit a \'<name>.rate\' item with'
+             ' the per second rate of every counter, computed against the'
+             ' previous execution')
+    parser.add_argument(
+        '--changed-only', dest='changed_only',
+        action='store_true', default=False,
+        help='\'stats\' and \'send\' only emit items whose value changed'
+             ' since the previous execution, plus all items every --heartbeat'
+             ' seconds')
+    parser.add_argument(
+        '--heartbeat', dest='heartbeat',
+        type=int, default=3600,
+        help='maximum number of seconds an unchanged item is not emitted when'
+             ' using --changed-only (defaults to 3600)')
+    parser.add_argument(
+        '--cli', dest='cli',
+        type=str, choices=('native', 'varnishadm'), default='native',
+        help='how to execute management CLI commands: using the built-in'
+             ' client, falling back to varnishadm when it is not possible, or'
+             ' always using varnishadm (defaults to "native")')
+    parser.add_argument(
+        '--source', dest='source',
+        type=str, choices=('varnishstat', 'vsm'), default='varnishstat',
+        help='how to fetch counters: executing varnishstat or reading them'
+             ' directly from the VSM, falling back to varnishstat when it is'
+             ' not possible; check the VSM reader on the target release using'
+             ' \'benchmarks/checks.py\' (defaults to "varnishstat")')
+    parser.add_argument(
+        '--filter', dest='filter',
+        type=str, choices=('varnishstat', 'script'), default='varnishstat',
+        help='where counters are filtered when executing varnishstat: pushing'
+             ' globs derived from items definitions & exclusions down to'
+             ' varnishstat (-f), or fetching all counters and filtering them'
+             ' only in this script (defaults to "varnishstat")')
+    parser.add_argument(
+        '-w', '--workers', dest='workers',
+        type=int, default=4,
+        help='maximum number of instances collected concurrently (defaults'
+             ' to 4)')
+    parser.add_argument(
+        '--timeout', dest='timeout',
+        type=float, default=5,
+        help='maximum time (in seconds) to collect stats of every instance;'
+             ' late instances are reported as failed and their varnishstat /'
+             ' varnishadm processes are killed (defaults to 5, 0 to disable)')
+    parser.add_argument(
+        '--backends-ttl', dest='backends_ttl',
+        type=int, default=0,
+        help='maximum age (in seconds) of the list of backends of the active'
+             ' VCL persisted in the state directory, reused instead of'
+             ' executing \'backend.list\' until the VCL state (i.e.'
+             ' \'vcl.list\') changes; requires \'VBE.*.is_healthy\' counters'
+             ' (defaults to 0, i.e. always execute \'backend.list\')')
+    parser.add_argument(
+        '--self-stats', dest='self_stats',
+        action='store_true', default=False,
+        help='also include \'SELF.*\' items describing the cost of every'
+             ' collection (stage durations, CPU time of child processes,'
+             ' counters seen / kept / excluded, output size, peak RSS)')
+    parser.add_argument(
+        '--profile', dest='profile',
+        type=str, default=None,
+        help='profile the execution of \'stats\', \'discover\' or'
+             ' \'send\' (collecting instances sequentially) and dump the'
+             ' cProfile results to the given file')
+    parser.add_argument(
+        '--aggregate', dest='aggregate',
+        action='store_true', default=False,
+        help='also include a synthetic \'{}\' instance summing counters &'
+             ' gauges of all instances (using the maximum for those that'
+             ' can\'t be summed, e.g. uptimes)'.format(AGGREGATE_INSTANCE))
+    parser.add_argument(
+        '--rollup-backends', dest='rollup_backends',
+        action='store_true', default=False,
+        help='aggregate dynamic backends (goto & dynamic VMODs) by director /'
+             ' host (e.g. \'goto.(http://foo.com:80)\'), including a'
+             ' \'VBE.*.endpoints\' item with the number of aggregated backends')
+    parser.add_argument(
+        '--top', dest='top',
+        type=top_argtype, action='append', default=[],
+        help='keep only the N most active subjects of a subject type (e.g.'
+             ' \'backends=100\'), folding all others into a synthetic'
+             ' \'{}\' subject; activity is computed against the previous'
+             ' execution, and kept subjects are only folded after ranking out'
+             ' of the top for {} consecutive executions; can be used multiple'
+             ' times'.format(TOP_OTHER, TOP_EVICTIONS))
+    parser.add_argument(
+        '--latency', dest='latency',
+        action='store_true', default=False,
+        help='also include \'LATENCY.*\' items (percentiles, maximum and'
+             ' bucket counts of request latencies) tailing varnishlog in the'
+             ' background; only available in \'serve\' and \'exporter\','
+             ' unless --latency-replay is used')
+    parser.add_argument(
+        '--latency-backends', dest='latency_backends',
+        action='store_true', default=False,
+        help='when using --latency, also include \'VBE.*.latency_*\' items'
+             ' for every backend')
+    parser.add_argument(
+        '--latency-window', dest='latency_window',
+        type=int, default=60,
+        help='when using --latency, length (in seconds) of the windows'
+             ' percentiles are computed over; items always describe the last'
+             ' completed window (defaults to 60)')
+    parser.add_argument(
+        '--latency-replay', dest='latency_replay',
+        type=str, default=None,
+        help='when using --latency, replay recorded varnishlog output (e.g.'
+             ' \'varnishlog -i BackendOpen,BackendReuse,Timestamp > FILE\')'
+             ' instead of tailing varnishlog')
     subparsers = parser.add_subparsers(dest='command')
 
     # Set up 'stats' command.
@@ -870,14 +3488,89 @@ def main():
         'discover',
         help='generate Zabbix discovery schema')
     subparser.add_argument(
-        'subject', type=str, choices=SUBJECTS.keys(),
-        help='dynamic resources to be discovered')
+        'subject', type=str, choices=list(SUBJECTS.keys()) + ['all'],
+        help='dynamic resources to be discovered (\'all\' for all of them,'
+             ' keyed by type, from a single collection)')
 
+    # Set up 'send' command.
+    subparser = subparsers.add_parser(
+        'send',
+        help='push Varnish Cache stats to a Zabbix server / proxy as trapper'
+             ' values')
+    subparser.add_argument(
+        '--server', dest='server',
+        type=str, default='127.0.0.1:10051',
+        help='Zabbix server / proxy address (defaults to "127.0.0.1:10051")')
+    subparser.add_argument(
+        '--host', dest='host',
+        type=str, default=None,
+        help='name of the host in Zabbix (defaults to the hostname)')
+    subparser.add_argument(
+        '--batch-size', dest='batch_size',
+        type=int, default=250,
+        help='maximum number of values per request (defaults to 250)')
+
+    # Set up 'exporter' command.
+    subparser = subparsers.add_parser(
+        'exporter',
+        help='serve Varnish Cache stats over HTTP (\'/metrics\') in the'
+             ' Prometheus exposition format')
+    subparser.add_argument(
+        '--listen', dest='listen',
+        type=str, default='0.0.0.0:9131',
+        help='address to listen on (defaults to "0.0.0.0:9131")')
+    subparser.add_argument(
+        '--scrape-window', dest='scrape_window',
+        type=int, default=5,
+        help='seconds during which concurrent or consecutive scrapes share a'
+             ' single collection (defaults to 5)')
+
+    # Set up 'serve' command.
+    subparser = subparsers.add_parser(
+        'serve',
+        help='run a collector daemon answering \'stats\' and \'discover\''
+             ' requests through the UNIX socket given by --socket')
+    subparser.add_argument(
+        '--interval', dest='interval',
+        type=int, default=60,
+        help='seconds between background collections (defaults to 60)')
+    subparser.add_argument(
+        '--socket-mode', dest='socket_mode',
+        type=lambda value: int(value, 8), default=0o660,
+        help='permissions of the UNIX socket (defaults to 0660)')
+
+    return parser
+
+
+def main():
     # Parse command line arguments.
+    parser = _parser()
     options = parser.parse_args()
-
-    # Execute command.
+    if options.command == 'serve' and options.socket is None:
+        parser.error('the \'serve\' command requires --socket')
+    if options.profile is not None and options.command in ('exporter', 'serve'):
+        parser.error('--profile is not supported by the \'{}\' command'.format(
+            options.command))
+    if options.aggregate and AGGREGATE_INSTANCE in _instances(options):
+        parser.error('\'{}\' is reserved for the aggregate of all instances'.format(
+            AGGREGATE_INSTANCE))
+
+    # Execute command, delegating to the collector daemon if possible.
     if options.command:
+        if options.profile is not None:
+            import cProfile
+            options.workers = 1
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(globals()[options.command], options)
+            finally:
+                profiler.dump_stats(options.profile)
+            sys.exit(0)
+        if options.socket is not None and options.command in ('stats', 'discover'):
+            output = _client(options.socket, sys.argv[1:])
+            if output is not None:
+                sys.stdout.write(output)
+                sys.exit(0)
         globals()[options.command](options)
     else:
         parser.print_help()